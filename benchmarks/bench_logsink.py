@@ -0,0 +1,47 @@
+"""
+Compares the full and the bounded restic log sinks on a synthetic `-vv` stream.
+
+Usage: py benchmarks/bench_logsink.py [number of lines]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from restic_monitor.logsink import FullLogSink, BoundedLogSink
+
+
+def synthetic_lines(count):
+    for i in range(count):
+        if i % 5000 == 0:
+            yield f"error: open C:\\Users\\me\\locked-{i}.dat: The process cannot access the file."
+        else:
+            yield f"unchanged  C:\\Users\\me\\AppData\\Local\\cache\\dir{i % 997}\\file{i}.bin"
+    yield "Files:        5307 new,     0 changed, 1000000 unmodified"
+    yield "Dirs:         1867 new,     0 changed,  100000 unmodified"
+    yield "Added to the repository: 241.234 MiB (82.117 MiB stored)"
+    yield f"processed {count} files, 237.839 GiB in 1:08:12"
+    yield "snapshot 8c2e8d68 saved"
+
+
+def run(name, sink, count):
+    start = time.perf_counter()
+    for line in synthetic_lines(count):
+        sink.write(line)
+    sink.close()
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(sink.filename)
+    print(f"{name:>8}: {elapsed:.2f}s, {count / elapsed:,.0f} lines/s, {size:,} bytes written")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    with tempfile.TemporaryDirectory() as d:
+        run("full", FullLogSink(os.path.join(d, "full.log")), count)
+        run("bounded", BoundedLogSink(os.path.join(d, "bounded.log"), checkpoint_seconds=10), count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Builds a snapshot index from synthetic `restic ls --json` listings and measures
+the indexing time, the index size and the search latency.
+
+Usage: py benchmarks/bench_snapshot_index.py [files per snapshot] [snapshots]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from restic_monitor.snapshot_index import SnapshotIndex
+
+
+def synthetic_tree(files, rng):
+    nodes = []
+    for i in range(files):
+        d = f"/C/Users/me/{'Documents' if i % 3 else 'AppData/Local'}/project{i % 211}/sub{i % 17}"
+        nodes.append({"struct_type": "node", "type": "file", "path": f"{d}/file{i}.dat",
+                      "size": rng.randrange(1, 1 << 24), "mtime": "2024-01-01T10:00:00.123456789+01:00"})
+    return nodes
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    snapshots = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rng = random.Random(1)
+    tree = synthetic_tree(files, rng)
+    with tempfile.TemporaryDirectory() as d:
+        db = os.path.join(d, "index.sqlite")
+        index = SnapshotIndex(db)
+        for n in range(snapshots):
+            # about 1% of the files change between snapshots
+            for node in rng.sample(tree, files // 100):
+                node["size"] += 1
+            started = time.perf_counter()
+            index.add_snapshot({"id": f"{n:064x}", "time": f"2024-01-{n + 1:02d}T00:00:00Z"}, iter(tree))
+            print(f"snapshot {n}: indexed {files:,} files in {time.perf_counter() - started:.2f}s")
+        index.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        print(f"index size: {os.path.getsize(db) / 1024 / 1024:.1f} MiB for {files * snapshots:,} entries")
+        for pattern in ["file12345.dat", "project42/sub3/file", "AppData", "fi"]:
+            started = time.perf_counter()
+            results = index.search(pattern, limit=100)
+            print(f"search {pattern!r}: {len(results)} results in {(time.perf_counter() - started) * 1000:.1f} ms")
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import subprocess
+import threading
+import time
+from subprocess import Popen
+
+
+class WorkCancelled(Exception):
+    pass
+
+
+class BackgroundWorker:
+    """
+    The restic processes and the run loop shared by SnapshotIndexer, RestoreVerifier and Replicator.
+
+    `run()` calls the blocking `work()` in an executor whenever `is_due()` and `should_run()`, and
+    cancels it as soon as `should_run()` turns False: the restic processes are killed, and starting
+    or finishing one raises `Cancelled`. `should_run()` is polled every `poll_seconds`, so interrupted
+    work starts again as soon as it can. By default the work is due again `check_seconds` after it
+    finished or failed, or right away after `wake_up()`.
+    """
+    Cancelled = WorkCancelled
+
+    def __init__(self, restic_exe, env, check_seconds=3600, poll_seconds=10):
+        self.restic_exe = restic_exe
+        self.env = env
+        self.check_seconds = check_seconds
+        self.poll_seconds = poll_seconds
+        self.logger = logging.getLogger(type(self).__name__)
+        self.logger.setLevel(logging.DEBUG)
+        self.lock = threading.RLock()
+        self.procs = set()
+        self.cancel_requested = False
+        self.next_check = 0
+        self.wakeup_event = asyncio.Event()
+
+    def _environ(self):
+        environ = os.environ.copy()
+        environ.update(self.env)
+        return environ
+
+    def _start(self, args, environ=None, stderr=subprocess.STDOUT):
+        " starts restic with its output in `proc.stdout`, call _done once it's over "
+        with self.lock:
+            if self.cancel_requested:
+                raise self.Cancelled()
+            proc = Popen([self.restic_exe] + args,
+                         env=environ or self._environ(),
+                         stdout=subprocess.PIPE,
+                         stderr=stderr,
+                         stdin=subprocess.DEVNULL,
+                         encoding="utf-8",
+                         errors="replace",
+                         creationflags=subprocess.CREATE_NO_WINDOW)
+            self.procs.add(proc)
+            return proc
+
+    def _done(self, proc):
+        with self.lock:
+            self.procs.discard(proc)
+            if self.cancel_requested:
+                raise self.Cancelled()
+
+    def _restic(self, args, environ=None, timeout=None):
+        """
+        Blocking, returns (exit code, output). Kills restic and raises subprocess.TimeoutExpired
+        after `timeout` seconds.
+        """
+        proc = self._start(args, environ)
+        try:
+            out, _ = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            self._done(proc)
+            raise
+        self._done(proc)
+        return proc.returncode, out
+
+    def cancel(self):
+        with self.lock:
+            self.cancel_requested = True
+            for proc in self.procs:
+                proc.kill()
+
+    def _begin(self):
+        " called by `work()` first "
+        with self.lock:
+            self.cancel_requested = False
+
+    def work(self):
+        raise NotImplementedError()
+
+    def is_due(self):
+        return time.monotonic() >= self.next_check
+
+    def wake_up(self):
+        " from the event loop, the work is due once the current one (if any) is over "
+        self.wakeup_event.set()
+
+    def on_finished(self, result):
+        self.next_check = time.monotonic() + self.check_seconds
+
+    def on_failed(self, e: Exception):
+        self.logger.error(f"{type(self).__name__} failed", exc_info=e)
+        self.next_check = time.monotonic() + self.check_seconds
+
+    async def run(self, should_run, should_quit):
+        name = type(self).__name__
+        self.logger.info(f"{name} is running")
+        loop = asyncio.get_running_loop()
+        while not should_quit():
+            try:
+                if self.is_due() and should_run():
+                    work = loop.run_in_executor(None, self.work)
+                    while not work.done():
+                        if not should_run() or should_quit():
+                            self.cancel()
+                        await asyncio.wait([work], timeout=1)
+                    try:
+                        result = work.result()
+                    except self.Cancelled:
+                        self.logger.info(f"{name} interrupted, will try again when it can")
+                    except Exception as e:
+                        self.on_failed(e)
+                    else:
+                        self.on_finished(result)
+            except:
+                self.logger.error(f"Exception in {name}.run", exc_info=1)
+                self.next_check = time.monotonic() + self.check_seconds
+            try:
+                await asyncio.wait_for(self.wakeup_event.wait(), self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+            if self.wakeup_event.is_set():
+                self.wakeup_event.clear()
+                self.next_check = 0
+        self.logger.info(f"{name} quit")
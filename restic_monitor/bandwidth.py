@@ -0,0 +1,124 @@
+import datetime
+import logging
+
+DAY_NAMES = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+# restic arguments that are replaced by the bandwidth profile
+LIMIT_UPLOAD_ARG = "--limit-upload"
+LIMIT_DOWNLOAD_ARG = "--limit-download"
+
+
+def _limit(value):
+    " restic treats a limit of 0 as unlimited "
+    if value is None or value <= 0:
+        return None
+    return value
+
+
+class BandwidthProfile:
+    """
+    A time-of-day window with upload/download caps in KiB/s, like restic's
+    --limit-upload and --limit-download. None means unlimited.
+    """
+    def __init__(self, name, start: datetime.time, end: datetime.time, days=None, limit_upload=None, limit_download=None):
+        self.name = name
+        self.start = start
+        self.end = end
+        # weekday numbers (0 is monday) the window starts on, None for every day
+        self.days = days
+        self.limit_upload = limit_upload
+        self.limit_download = limit_download
+
+    @staticmethod
+    def from_json(value: dict):
+        days = value.get("days")
+        if days is not None:
+            days = [DAY_NAMES.index(d.lower()[:3]) if isinstance(d, str) else int(d) for d in days]
+        return BandwidthProfile(
+            name=value.get("name", f"{value['start']}-{value['end']}"),
+            start=datetime.time.fromisoformat(value["start"]),
+            end=datetime.time.fromisoformat(value["end"]),
+            days=days,
+            limit_upload=_limit(value.get("limit_upload")),
+            limit_download=_limit(value.get("limit_download")))
+
+    def matches(self, now: datetime.datetime):
+        t = now.time()
+        if self.start <= self.end:
+            in_window = self.start <= t < self.end
+            start_day = now.weekday()
+        else:
+            # crosses midnight, e.g. 22:00-06:00
+            in_window = t >= self.start or t < self.end
+            start_day = now.weekday() if t >= self.start else (now.weekday() - 1) % 7
+        return in_window and (self.days is None or start_day in self.days)
+
+    def restic_args(self):
+        args = []
+        if self.limit_upload is not None:
+            args.append(f"{LIMIT_UPLOAD_ARG}={int(self.limit_upload)}")
+        if self.limit_download is not None:
+            args.append(f"{LIMIT_DOWNLOAD_ARG}={int(self.limit_download)}")
+        return args
+
+    def __repr__(self):
+        return f"BandwidthProfile({self.name}, up={self.limit_upload}, down={self.limit_download})"
+
+
+UNLIMITED_PROFILE = BandwidthProfile("unlimited", datetime.time(0), datetime.time(0))
+
+
+class BandwidthPolicy:
+    """
+    Picks the bandwidth profile for the time of day and decides whether a running backup
+    is worth restarting when it crosses into another profile.
+
+    restic can't change its limits while running, so the switch means killing restic and
+    running it again. Thanks to deduplication the new run only uploads what the killed one
+    didn't, but it scans everything again, so the switch is only made when a limit changes
+    by at least `min_change_ratio`.
+
+    The measured throughput can't tell whether a limit matters: restic's bytes_done includes
+    the unchanged files it reads, so on an incremental run it's the disk speed, not the upload.
+    """
+    def __init__(self, profiles, min_change_ratio=2.0):
+        self.profiles = profiles
+        self.min_change_ratio = min_change_ratio
+        self.logger = logging.getLogger("BandwidthPolicy")
+
+    @staticmethod
+    def from_json(profiles: list, min_change_ratio=2.0):
+        return BandwidthPolicy([BandwidthProfile.from_json(p) for p in profiles], min_change_ratio=min_change_ratio)
+
+    def profile_at(self, now: datetime.datetime):
+        for p in self.profiles:
+            if p.matches(now):
+                return p
+        return UNLIMITED_PROFILE
+
+    def restic_args(self, args, profile: BandwidthProfile):
+        " replaces the limits in `args` with the ones from the profile "
+        stripped = []
+        skip_next = False
+        for a in args:
+            if skip_next:
+                skip_next = False
+            elif a in (LIMIT_UPLOAD_ARG, LIMIT_DOWNLOAD_ARG):
+                skip_next = True
+            elif not a.startswith((LIMIT_UPLOAD_ARG + "=", LIMIT_DOWNLOAD_ARG + "=")):
+                stripped.append(a)
+        return stripped + profile.restic_args()
+
+    def _should_switch_limit(self, old, new):
+        inf = float("inf")
+        old_bps = inf if old is None else old * 1024
+        new_bps = inf if new is None else new * 1024
+        if old_bps == new_bps:
+            return False
+        return max(old_bps, new_bps) / min(old_bps, new_bps) >= self.min_change_ratio
+
+    def should_restart(self, current: BandwidthProfile, new: BandwidthProfile):
+        if current is new:
+            return False
+        return self._should_switch_limit(current.limit_upload, new.limit_upload) or \
+            self._should_switch_limit(current.limit_download, new.limit_download)
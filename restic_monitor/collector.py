@@ -0,0 +1,203 @@
+"""
+Reference fleet collector for FleetReporter.
+
+Stores the reports from every machine in SQLite and answers which machines have
+not backed up recently. Run it with
+
+    py -m restic_monitor.collector --port 8080 --db fleet.db
+
+and point `report_url` in settings.json to http://<host>:8080/reports.
+
+Endpoints:
+
+* POST /reports: a (optionally gzipped) JSON body of {"machine": ..., "records": [...]}
+* GET /machines: every known machine
+* GET /machines/stale?seconds=N: machines without a successful backup in the last N seconds
+"""
+import argparse
+import gzip
+import json
+import logging
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS machines (
+    machine TEXT PRIMARY KEY,
+    last_seen REAL NOT NULL,
+    last_success REAL,
+    last_run_finished REAL,
+    last_run_code INTEGER,
+    running INTEGER,
+    paused INTEGER
+);
+-- machines that never succeeded have a NULL last_success
+CREATE INDEX IF NOT EXISTS machines_last_success ON machines(last_success);
+CREATE TABLE IF NOT EXISTS runs (
+    machine TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL NOT NULL,
+    code INTEGER,
+    cancelled INTEGER,
+    PRIMARY KEY (machine, started)
+) WITHOUT ROWID;
+"""
+
+MACHINE_COLUMNS = ["machine", "last_seen", "last_success", "last_run_finished", "last_run_code", "running", "paused"]
+
+
+class FleetStore:
+    def __init__(self, db_filename):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def _touch_machine(self, machine, now):
+        self.db.execute("INSERT INTO machines (machine, last_seen) VALUES (?, ?) "
+                        "ON CONFLICT(machine) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)",
+                        (machine, now))
+
+    def _add_run(self, machine, r):
+        # retried batches may deliver the same run twice
+        cursor = self.db.execute("INSERT OR IGNORE INTO runs (machine, started, finished, code, cancelled) "
+                                 "VALUES (?, ?, ?, ?, ?)",
+                                 (machine, r["started"], r["finished"], r["code"], int(bool(r["cancelled"]))))
+        if cursor.rowcount == 0:
+            return
+        self.db.execute("UPDATE machines SET "
+                        "last_run_code = CASE WHEN last_run_finished IS NULL OR last_run_finished <= :finished "
+                        "    THEN :code ELSE last_run_code END, "
+                        "last_run_finished = MAX(COALESCE(last_run_finished, 0), :finished) "
+                        "WHERE machine = :machine",
+                        dict(machine=machine, finished=r["finished"], code=r["code"]))
+        if r["code"] == 0:
+            self._update_last_success(machine, r["finished"])
+
+    def _update_last_success(self, machine, last_success):
+        self.db.execute("UPDATE machines SET last_success = MAX(COALESCE(last_success, 0), ?) WHERE machine = ?",
+                        (last_success, machine))
+
+    def _add_heartbeat(self, machine, r):
+        self.db.execute("UPDATE machines SET running = ?, paused = ? WHERE machine = ?",
+                        (int(bool(r.get("running"))), int(bool(r.get("paused"))), machine))
+        if r.get("last_success") is not None:
+            self._update_last_success(machine, r["last_success"])
+
+    def add_report(self, report: dict):
+        machine = report["machine"]
+        with self.lock, self.db:
+            self._touch_machine(machine, time.time())
+            for r in report["records"]:
+                if r["type"] == "run":
+                    self._add_run(machine, r)
+                elif r["type"] == "heartbeat":
+                    self._add_heartbeat(machine, r)
+
+    def _query_machines(self, sql, params=()):
+        " `sql` selects {columns} "
+        with self.lock:
+            rows = self.db.execute(sql.format(columns=", ".join(MACHINE_COLUMNS)), params).fetchall()
+        return [dict(zip(MACHINE_COLUMNS, row)) for row in rows]
+
+    def machines(self):
+        return self._query_machines("SELECT {columns} FROM machines ORDER BY machine")
+
+    def stale_machines(self, seconds):
+        """
+        Machines without a successful backup in the last `seconds`, the ones that never succeeded first.
+        Both halves are range searches on the last_success index, so the cost grows with the result
+        rather than the fleet. An `IS NULL OR <` condition would scan the whole index instead.
+        """
+        cutoff = time.time() - seconds
+        return self._query_machines("SELECT {columns} FROM machines WHERE last_success IS NULL "
+                                    "UNION ALL "
+                                    "SELECT {columns} FROM machines WHERE last_success < ? "
+                                    "ORDER BY last_success",
+                                    (cutoff,))
+
+
+class CollectorRequestHandler(BaseHTTPRequestHandler):
+    # set by make_server()
+    store: FleetStore = None
+    token: str = None
+
+    def _send_json(self, code, value):
+        body = json.dumps(value).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        if self.token and self.headers.get("Authorization") != f"Bearer {self.token}":
+            self._send_json(401, {"error": "unauthorized"})
+            return False
+        return True
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if urlparse(self.path).path != "/reports":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            self.store.add_report(json.loads(body))
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        self._send_json(200, {"ok": True})
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        url = urlparse(self.path)
+        if url.path == "/machines":
+            self._send_json(200, self.store.machines())
+        elif url.path == "/machines/stale":
+            try:
+                seconds = float(parse_qs(url.query)["seconds"][0])
+            except (KeyError, ValueError):
+                self._send_json(400, {"error": "seconds is required"})
+                return
+            self._send_json(200, self.store.stale_machines(seconds))
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def log_message(self, format, *args):
+        logging.getLogger("Collector").info(format % args)
+
+
+def make_server(host, port, db_filename, token=None):
+    handler = type("BoundCollectorRequestHandler", (CollectorRequestHandler,),
+                   dict(store=FleetStore(db_filename), token=token))
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def run():
+    parser = argparse.ArgumentParser(description="restic-monitor fleet collector")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--db", default="fleet.db", help="SQLite database file")
+    parser.add_argument("--token", help="require this bearer token from the reporters")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] (%(name)s): %(message)s")
+    server = make_server(args.host, args.port, args.db, args.token)
+    logging.info(f"Collector listening on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    run()
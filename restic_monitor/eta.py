@@ -0,0 +1,182 @@
+import json
+import math
+import threading
+
+
+def format_duration(seconds):
+    seconds = int(max(seconds, 0))
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes = seconds // 60
+    if minutes < 60:
+        return f"{minutes}m"
+    return f"{minutes // 60}h {minutes % 60}m"
+
+
+class EtaEstimator:
+    """
+    Estimates the time left in a running backup from the status messages of `restic backup --json`
+    and the history of the bandwidth profile (see RunHistory.profile_stats).
+
+    While restic is still scanning, the total is unknown, so the historical total size and scan
+    duration are used. The throughput is the live moving average, blended with the historical
+    throughput until `warmup_seconds` into the run. The band is the throughput give or take
+    `band_deviations` standard deviations.
+
+    The files left count too, at the live moving average of files per second, once the scan is
+    over and the warmup too (the history has no file rate). Whichever of bytes and files gives the
+    longer time wins: a stretch of many small files is slow for its size, a large file is slow
+    for one file. Each message is handled in constant time.
+    """
+    def __init__(self, time_constant_seconds=30, warmup_seconds=120, band_deviations=1.64, smoothing=0.2):
+        self.time_constant_seconds = time_constant_seconds
+        self.warmup_seconds = warmup_seconds
+        self.band_deviations = band_deviations
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.begin(None)
+
+    def begin(self, history_stats):
+        " called every time restic starts "
+        with self.lock:
+            self.history = history_stats or {}
+            self.elapsed = None
+            self.bytes_done = 0
+            self.total_bytes = None
+            self.files_done = 0
+            self.total_files = None
+            self.percent = None
+            self.scan_seconds = None
+            self.rate = None
+            self.rate_var = 0.0
+            self.files_rate = None
+            self.eta = None
+            self.eta_elapsed = None
+            self.eta_low = None
+            self.eta_high = None
+            self.summary = None
+
+    def on_line(self, line: str):
+        if not line.startswith("{"):
+            return
+        if '"message_type":"status"' in line:
+            try:
+                self._on_status(json.loads(line))
+            except ValueError:
+                return
+        elif '"message_type":"summary"' in line:
+            try:
+                summary = json.loads(line)
+            except ValueError:
+                return
+            with self.lock:
+                self.summary = summary
+
+    def _on_status(self, status):
+        elapsed = status.get("seconds_elapsed")
+        if elapsed is None:
+            return
+        done = status.get("bytes_done", 0)
+        files_done = status.get("files_done", 0)
+        with self.lock:
+            if self.elapsed is not None and elapsed > self.elapsed:
+                dt = elapsed - self.elapsed
+                sample = (done - self.bytes_done) / dt
+                files_sample = (files_done - self.files_done) / dt
+                if self.rate is None:
+                    self.rate = sample
+                    self.files_rate = files_sample
+                else:
+                    alpha = min(1.0, dt / self.time_constant_seconds)
+                    deviation = sample - self.rate
+                    self.rate += alpha * deviation
+                    self.rate_var += alpha * (deviation * deviation - self.rate_var)
+                    self.files_rate += alpha * (files_sample - self.files_rate)
+            self.elapsed = elapsed
+            self.bytes_done = done
+            self.files_done = files_done
+            self.total_bytes = status.get("total_bytes")
+            self.total_files = status.get("total_files")
+            self.percent = status.get("percent_done")
+            # restic only estimates the time left once the scan is over
+            if self.scan_seconds is None and "seconds_remaining" in status:
+                self.scan_seconds = elapsed
+            self._update_eta()
+
+    def _update_eta(self):
+        " must hold the lock "
+        hist_rate = self.history.get("bytes_per_second")
+        weight = 0.0 if self.rate is None else min(1.0, self.elapsed / self.warmup_seconds)
+        if hist_rate is None:
+            if self.rate is None:
+                return
+            weight = 1.0
+        rate = weight * (self.rate or 0) + (1 - weight) * (hist_rate or 0)
+        var = weight * self.rate_var + (1 - weight) * self.history.get("bytes_per_second_var", 0)
+        if rate <= 0:
+            return
+
+        scan_left = 0
+        if self.scan_seconds is not None:
+            remaining = (self.total_bytes or 0) - self.bytes_done
+        elif "total_bytes" in self.history:
+            remaining = max(self.total_bytes or 0, self.history["total_bytes"]) - self.bytes_done
+            scan_left = max(0, self.history.get("scan_seconds", 0) - self.elapsed)
+        else:
+            # still scanning and never seen a full run, nothing to go by
+            return
+        remaining = max(remaining, 0)
+        spread = self.band_deviations * math.sqrt(var)
+        eta = max(remaining / rate, scan_left)
+        low = max(remaining / (rate + spread), scan_left)
+        high = max(remaining / max(rate - spread, rate * 0.25), scan_left)
+        if self.scan_seconds is not None and weight >= 1.0 and self.total_files and self.files_rate:
+            files_eta = max(self.total_files - self.files_done, 0) / self.files_rate
+            if files_eta > eta:
+                # the band scales with the estimate
+                scale = files_eta / eta if eta > 0 else 1.0
+                low, high, eta = low * scale, high * scale, files_eta
+
+        if self.eta is None:
+            self.eta = eta
+        else:
+            # what the previous estimate says now, nudged towards the new one
+            predicted = self.eta - (self.elapsed - self.eta_elapsed)
+            self.eta = predicted + self.smoothing * (eta - predicted)
+        self.eta_elapsed = self.elapsed
+        self.eta_low = min(low, self.eta)
+        self.eta_high = max(high, self.eta)
+
+    def estimate(self):
+        """
+        Returns (percent done, seconds left, low, high), or None when there's no estimate yet.
+        """
+        with self.lock:
+            if self.eta is None:
+                return None
+            return (self.percent or 0) * 100, self.eta, self.eta_low, self.eta_high
+
+    def progress_text(self):
+        estimate = self.estimate()
+        if estimate is None:
+            return None
+        percent, eta, low, high = estimate
+        return f"{percent:.0f}%, {format_duration(eta)} left ({format_duration(low)}-{format_duration(high)})"
+
+    def run_stats(self):
+        " the stats of the run for RunHistory, from the summary if restic printed one "
+        with self.lock:
+            stats = {
+                "bytes_done": self.bytes_done,
+                "total_bytes": self.total_bytes,
+                "files_done": self.files_done,
+                "total_files": self.total_files,
+                "scan_seconds": self.scan_seconds,
+                "transfer_seconds": self.elapsed,
+            }
+            if self.summary:
+                stats["bytes_done"] = self.summary.get("total_bytes_processed", self.bytes_done)
+                stats["total_bytes"] = stats["bytes_done"]
+                stats["files_done"] = self.summary.get("total_files_processed", self.files_done)
+                stats["transfer_seconds"] = self.summary.get("total_duration", self.elapsed)
+            return stats
@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+import threading
+
+DEFAULT_PROFILE = "default"
+
+
+class RunHistory:
+    """
+    Persists the recent run records and, per bandwidth profile, exponential moving
+    averages of what the successful runs looked like: throughput, its variance,
+    the duration of the scan and the total size. Used by EtaEstimator.
+
+    Also keeps the results of the restore verifications, see RestoreVerifier.
+    """
+    MAX_RUNS = 200
+
+    def __init__(self, filename, alpha=0.3):
+        self.filename = filename
+        self.alpha = alpha
+        self.logger = logging.getLogger("RunHistory")
+        self.lock = threading.RLock()
+        self.data = self._load()
+
+    def _load(self):
+        try:
+            if os.path.exists(self.filename):
+                with open(self.filename, "r") as f:
+                    data = json.loads(f.read())
+                    data.setdefault("runs", [])
+                    data.setdefault("profiles", {})
+                    data.setdefault("verifications", [])
+                    return data
+        except:
+            self.logger.warn(f"Failed to read {self.filename}", exc_info=1)
+        return {"runs": [], "profiles": {}, "verifications": []}
+
+    def _save(self):
+        " must hold the lock "
+        tmp_filename = self.filename + ".tmp"
+        try:
+            with open(tmp_filename, "w") as f:
+                f.write(json.dumps(self.data))
+            os.replace(tmp_filename, self.filename)
+        except:
+            self.logger.warn(f"Failed to persist the run history to {self.filename}", exc_info=1)
+
+    def profile_stats(self, profile):
+        with self.lock:
+            stats = self.data["profiles"].get(profile or DEFAULT_PROFILE)
+            return dict(stats) if stats else None
+
+    def runs(self):
+        with self.lock:
+            return list(self.data["runs"])
+
+    def _ewma(self, stats, key, value):
+        if key not in stats:
+            stats[key] = value
+        else:
+            stats[key] += self.alpha * (value - stats[key])
+
+    def _update_profile(self, record):
+        " must hold the lock "
+        seconds = record.get("transfer_seconds")
+        if not seconds or not record.get("bytes_done"):
+            return
+        stats = self.data["profiles"].setdefault(record.get("bandwidth_profile") or DEFAULT_PROFILE, {"runs": 0})
+        rate = record["bytes_done"] / seconds
+        if "bytes_per_second" in stats:
+            # exponentially weighted variance, around the average before this run
+            deviation = rate - stats["bytes_per_second"]
+            self._ewma(stats, "bytes_per_second_var", deviation * deviation)
+        self._ewma(stats, "bytes_per_second", rate)
+        self._ewma(stats, "total_bytes", record.get("total_bytes") or record["bytes_done"])
+        if record.get("scan_seconds") is not None:
+            self._ewma(stats, "scan_seconds", record["scan_seconds"])
+        stats["runs"] += 1
+
+    def add_run(self, record: dict):
+        " run listener for ResticMonitor "
+        with self.lock:
+            self.data["runs"] = (self.data["runs"] + [record])[-RunHistory.MAX_RUNS:]
+            # restarted runs re-read what was already backed up, which skews the throughput
+            if record.get("code") in (0, 3) and not record.get("cancelled") and not record.get("restarts"):
+                self._update_profile(record)
+            self._save()
+
+    def add_verification(self, record: dict):
+        with self.lock:
+            self.data["verifications"] = (self.data["verifications"] + [record])[-RunHistory.MAX_RUNS:]
+            self._save()
+
+    def last_verification(self):
+        with self.lock:
+            verifications = self.data["verifications"]
+            return dict(verifications[-1]) if verifications else None
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import subprocess
+import threading
+import time
+from subprocess import Popen
+
+# the exit code of a run when a hook or a producer failed, like restic's own "fatal error"
+HOOK_FAILED_CODE = 1
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class HookCancelled(Exception):
+    " raised by HookRunner.spawn when the run has been cancelled "
+    pass
+
+
+class HookCommand:
+    " a pre-backup or post-backup command "
+    def __init__(self, command: list, name=None, timeout_seconds=600):
+        self.command = command
+        self.name = name or command[0]
+        self.timeout_seconds = timeout_seconds
+
+    @staticmethod
+    def from_json(value: dict):
+        return HookCommand(value["command"], value.get("name"), float(value.get("timeout_seconds", 600)))
+
+
+class StdinBackup:
+    """
+    A producer command whose stdout is backed up with `restic backup --stdin`,
+    e.g. a database dump, without staging it on disk.
+    """
+    def __init__(self, command: list, filename: str, args=None, name=None, timeout_seconds=None):
+        self.command = command
+        self.filename = filename
+        # additional arguments to `restic backup`, e.g. tags
+        self.args = args or []
+        self.name = name or filename
+        self.timeout_seconds = timeout_seconds
+
+    @staticmethod
+    def from_json(value: dict):
+        timeout = value.get("timeout_seconds")
+        return StdinBackup(value["command"],
+                           value["filename"],
+                           args=value.get("args"),
+                           name=value.get("name"),
+                           timeout_seconds=None if timeout is None else float(timeout))
+
+
+class HookRunner:
+    """
+    Runs the processes of a HookPipeline for a single run of ResticMonitor.run_backup.
+
+    `spawn` starts a process the same way the monitor starts restic, so that the monitor
+    can kill it on cancel. It raises HookCancelled if the run has been cancelled.
+    """
+    def __init__(self, spawn, sink, onprogress):
+        self.spawn = spawn
+        self.sink = sink
+        self.onprogress = onprogress
+        self.logger = logging.getLogger("HookRunner")
+
+    def _pump(self, stream, prefix):
+        " copies the output of a process into the restic log, in its own thread "
+        try:
+            for line in stream:
+                if isinstance(line, bytes):
+                    line = line.decode("utf-8", errors="replace")
+                self.sink.write(f"[{prefix}] {line.rstrip()}")
+        except:
+            self.logger.error(f"Failed to read the output of {prefix}", exc_info=1)
+        finally:
+            stream.close()
+
+    def _start_pump(self, stream, prefix):
+        t = threading.Thread(target=self._pump, args=(stream, prefix), name=f"hook-{prefix}", daemon=True)
+        t.start()
+        return t
+
+    async def wait(self, proc: Popen, timeout_seconds):
+        """
+        Waits for the process like run_backup waits for restic.
+        Kills it and returns False if it didn't finish within `timeout_seconds`.
+        """
+        deadline = None if timeout_seconds is None else time.monotonic() + timeout_seconds
+        while proc.poll() is None:
+            if deadline is not None and time.monotonic() > deadline:
+                proc.kill()
+                await asyncio.get_running_loop().run_in_executor(None, proc.wait)
+                return False
+            self.onprogress()
+            await asyncio.sleep(1)
+        return True
+
+    async def run_command(self, hook: HookCommand, extra_env=None):
+        """
+        Returns None on success or the failure message.
+        """
+        self.sink.write(f"[restic-monitor: running hook {hook.name}]")
+        try:
+            proc = self.spawn(hook.command, extra_env=extra_env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as e:
+            return f"hook {hook.name} failed to start: {e}"
+        pump = self._start_pump(proc.stdout, hook.name)
+        finished = await self.wait(proc, hook.timeout_seconds)
+        await asyncio.get_running_loop().run_in_executor(None, pump.join)
+        if not finished:
+            return f"hook {hook.name} timed out after {hook.timeout_seconds}s"
+        if proc.returncode != 0:
+            return f"hook {hook.name} failed with code {proc.returncode}"
+        return None
+
+    def _copy(self, src, dst, producer: Popen, failed: list):
+        """
+        Copies the producer output into restic, in its own thread. stdin of restic is left
+        open so that restic doesn't save a snapshot of a truncated dump if the producer fails.
+        """
+        try:
+            while True:
+                chunk = src.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        except OSError as e:
+            # restic went away, no point in producing more
+            failed.append(str(e))
+            producer.kill()
+        finally:
+            src.close()
+
+    async def run_stdin_backup(self, backup: StdinBackup, restic_command: list):
+        """
+        Pipes the producer into `restic backup --stdin`. Returns None on success or the failure message.
+        """
+        self.sink.write(f"[restic-monitor: backing up the output of {backup.name} as {backup.filename}]")
+        try:
+            producer = self.spawn(backup.command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            return f"{backup.name} failed to start: {e}"
+        try:
+            restic = self.spawn(restic_command + ["--stdin", f"--stdin-filename={backup.filename}"] + backup.args,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except:
+            producer.kill()
+            raise
+        pumps = [self._start_pump(producer.stderr, backup.name),
+                 self._start_pump(restic.stdout, f"restic {backup.name}")]
+        copy_failures = []
+        copier = threading.Thread(target=self._copy,
+                                  args=(producer.stdout, restic.stdin, producer, copy_failures),
+                                  name=f"stdin-{backup.name}",
+                                  daemon=True)
+        copier.start()
+
+        loop = asyncio.get_running_loop()
+        finished = await self.wait(producer, backup.timeout_seconds)
+        await loop.run_in_executor(None, copier.join)
+        failure = None
+        if not finished:
+            failure = f"{backup.name} timed out after {backup.timeout_seconds}s"
+        elif producer.returncode != 0:
+            failure = f"{backup.name} failed with code {producer.returncode}"
+        elif copy_failures:
+            failure = f"failed to pipe {backup.name} into restic: {copy_failures[0]}"
+
+        if failure is None:
+            try:
+                restic.stdin.close()
+            except OSError:
+                pass
+            await self.wait(restic, None)
+            if restic.returncode != 0:
+                failure = f"restic failed with code {restic.returncode} backing up {backup.name}"
+        else:
+            restic.kill()
+            await loop.run_in_executor(None, restic.wait)
+            try:
+                restic.stdin.close()
+            except OSError:
+                pass
+        for p in pumps:
+            await loop.run_in_executor(None, p.join)
+        return failure
+
+
+class HookPipeline:
+    """
+    The stages around the main `restic backup` of ResticMonitor.run_backup:
+
+    1. `pre` commands, one by one. The backup is skipped if any of them fails.
+    2. the main backup.
+    3. `stdin_backups`, up to `max_concurrent_stdin_backups` at a time.
+    4. `post` commands, one by one, with RESTIC_MONITOR_EXIT_CODE in their environment.
+
+    Each stage returns the list of failure messages.
+    """
+    def __init__(self, pre=None, post=None, stdin_backups=None, max_concurrent_stdin_backups=2):
+        self.pre = pre or []
+        self.post = post or []
+        self.stdin_backups = stdin_backups or []
+        self.max_concurrent_stdin_backups = max_concurrent_stdin_backups
+
+    def is_empty(self):
+        return not (self.pre or self.post or self.stdin_backups)
+
+    async def run_pre(self, runner: HookRunner):
+        for hook in self.pre:
+            failure = await runner.run_command(hook)
+            if failure:
+                return [failure]
+        return []
+
+    async def run_stdin_backups(self, runner: HookRunner, restic_command: list):
+        semaphore = asyncio.Semaphore(self.max_concurrent_stdin_backups)
+        async def run_one(backup):
+            async with semaphore:
+                return await runner.run_stdin_backup(backup, restic_command)
+        results = await asyncio.gather(*[run_one(b) for b in self.stdin_backups], return_exceptions=True)
+        return [str(r) for r in results if r is not None and not isinstance(r, HookCancelled)]
+
+    async def run_post(self, runner: HookRunner, exit_code):
+        failures = []
+        for hook in self.post:
+            try:
+                failure = await runner.run_command(hook, extra_env={"RESTIC_MONITOR_EXIT_CODE": str(exit_code)})
+            except HookCancelled:
+                # the run was cancelled, the failures so far still count
+                break
+            if failure:
+                failures.append(failure)
+        return failures
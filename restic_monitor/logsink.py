@@ -0,0 +1,141 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+# prefixes of the lines restic prints at the end of a `backup` run
+SUMMARY_PREFIXES = (
+    "Files:",
+    "Dirs:",
+    "Added to the repo",
+    "processed ",
+    "snapshot ",
+)
+
+# prefixes (lower-cased) of the lines worth keeping no matter how noisy the run is
+IMPORTANT_PREFIXES = (
+    "error",
+    "warning",
+    "fatal",
+)
+
+
+def is_summary_line(line: str):
+    return line.startswith(SUMMARY_PREFIXES) or '"message_type":"summary"' in line
+
+
+def is_important_line(line: str):
+    return line[:16].lstrip().lower().startswith(IMPORTANT_PREFIXES) or '"message_type":"error"' in line
+
+
+class FullLogSink:
+    """
+    Writes every line of the restic output to the log file, like restic itself would.
+    """
+    def __init__(self, filename, recent_lines=16):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.recent = collections.deque(maxlen=recent_lines)
+        self.file = open(filename, "w", encoding="utf-8", errors="replace")
+
+    def write(self, line: str):
+        with self.lock:
+            self.recent.append(line)
+            self.file.write(line)
+            self.file.write("\n")
+
+    def last_lines(self, lines=1):
+        with self.lock:
+            return "\n".join(list(self.recent)[-lines:])
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class BoundedLogSink:
+    """
+    Keeps only the parts of the restic output that people actually read:
+    the first `head_lines` lines, the last `tail_lines` lines, the error/warning lines
+    (up to `max_error_lines`) and the final summary. Everything else is counted and dropped.
+
+    Memory is bounded by the limits above. The file is rewritten every
+    `checkpoint_seconds` and once more on close(), instead of on every line.
+    """
+    MAX_SUMMARY_LINES = 32
+
+    def __init__(self, filename, head_lines=200, tail_lines=200, max_error_lines=1000, checkpoint_seconds=60):
+        self.filename = filename
+        self.head_lines = head_lines
+        self.max_error_lines = max_error_lines
+        self.checkpoint_seconds = checkpoint_seconds
+        self.logger = logging.getLogger("BoundedLogSink")
+        self.lock = threading.Lock()
+        # (line number, line) tuples
+        self.head = []
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.errors = []
+        self.summary = collections.deque(maxlen=BoundedLogSink.MAX_SUMMARY_LINES)
+        self.total_lines = 0
+        self.dropped_errors = 0
+        self.last_checkpoint = time.monotonic()
+
+    def write(self, line: str):
+        checkpoint = False
+        with self.lock:
+            entry = (self.total_lines, line)
+            self.total_lines += 1
+            if len(self.head) < self.head_lines:
+                self.head.append(entry)
+            else:
+                self.tail.append(entry)
+                if is_summary_line(line):
+                    self.summary.append(entry)
+                elif is_important_line(line):
+                    if len(self.errors) < self.max_error_lines:
+                        self.errors.append(entry)
+                    else:
+                        self.dropped_errors += 1
+            now = time.monotonic()
+            if now - self.last_checkpoint >= self.checkpoint_seconds:
+                self.last_checkpoint = now
+                checkpoint = True
+        if checkpoint:
+            self.checkpoint()
+
+    def last_lines(self, lines=1):
+        with self.lock:
+            kept = list(self.tail) if self.tail else self.head
+            return "\n".join(l for _, l in kept[-lines:])
+
+    def _render(self):
+        " must hold the lock "
+        kept = {}
+        for lineno, line in [*self.head, *self.errors, *self.summary, *self.tail]:
+            kept[lineno] = line
+        out = []
+        expected = 0
+        for lineno in sorted(kept):
+            if lineno != expected:
+                out.append(f"[... {lineno - expected} lines omitted ...]")
+            out.append(kept[lineno])
+            expected = lineno + 1
+        dropped = self.total_lines - len(kept)
+        out.append(f"[restic-monitor: kept {len(kept)} of {self.total_lines} lines, "
+                   f"dropped {dropped} lines including {self.dropped_errors} error/warning lines]")
+        return "\n".join(out) + "\n"
+
+    def checkpoint(self):
+        with self.lock:
+            content = self._render()
+        tmp_filename = self.filename + ".tmp"
+        try:
+            with open(tmp_filename, "w", encoding="utf-8", errors="replace") as f:
+                f.write(content)
+            os.replace(tmp_filename, self.filename)
+        except:
+            self.logger.warn(f"Failed to checkpoint {self.filename}", exc_info=1)
+
+    def close(self):
+        self.checkpoint()
@@ -15,6 +15,38 @@ MIN_IDLE_SECONDS_SETTING = 'min_idle_seconds'
 IGNORE_EXIT_CODE_3_SETTING = 'ignore_exit_code_3'
 NO_BACKUP_WARNING_SETTING = 'no_backup_warning_seconds'
 MIN_SECONDS_BETWEEN_BACKUPS_SETTING = 'min_seconds_between_backups'
+LOG_MODE_SETTING = 'log_mode'
+LOG_HEAD_LINES_SETTING = 'log_head_lines'
+LOG_TAIL_LINES_SETTING = 'log_tail_lines'
+LOG_MAX_ERROR_LINES_SETTING = 'log_max_error_lines'
+LOG_CHECKPOINT_SECONDS_SETTING = 'log_checkpoint_seconds'
+REPORT_URL_SETTING = 'report_url'
+REPORT_MACHINE_SETTING = 'report_machine'
+REPORT_TOKEN_SETTING = 'report_token'
+REPORT_HEARTBEAT_SECONDS_SETTING = 'report_heartbeat_seconds'
+REPORT_OUTBOX_FILENAME = "report-outbox.json"
+BANDWIDTH_PROFILES_SETTING = 'bandwidth_profiles'
+BANDWIDTH_MIN_CHANGE_RATIO_SETTING = 'bandwidth_min_change_ratio'
+PRE_BACKUP_HOOKS_SETTING = 'pre_backup_hooks'
+POST_BACKUP_HOOKS_SETTING = 'post_backup_hooks'
+STDIN_BACKUPS_SETTING = 'stdin_backups'
+MAX_CONCURRENT_STDIN_BACKUPS_SETTING = 'max_concurrent_stdin_backups'
+CANCEL_ON_ACTIVITY_SETTING = 'cancel_on_activity'
+SNAPSHOT_INDEX_SETTING = 'snapshot_index'
+SNAPSHOT_INDEX_HOST_SETTING = 'snapshot_index_host'
+SNAPSHOT_INDEX_FILENAME = "snapshot-index.sqlite"
+RUN_HISTORY_FILENAME = "run-history.json"
+SCAN_PROFILER_SETTING = 'scan_profiler'
+SCAN_PROFILE_FILENAME = "scan-profile.txt"
+RESTORE_VERIFICATION_SETTING = 'restore_verification'
+RESTORE_VERIFICATION_INTERVAL_SECONDS_SETTING = 'restore_verification_interval_seconds'
+RESTORE_VERIFICATION_MAX_FILES_SETTING = 'restore_verification_max_files'
+RESTORE_VERIFICATION_MAX_BYTES_SETTING = 'restore_verification_max_bytes'
+RESTORE_VERIFICATION_MAX_SECONDS_SETTING = 'restore_verification_max_seconds'
+RESTORE_VERIFICATION_WORKERS_SETTING = 'restore_verification_workers'
+REPLICATION_TARGETS_SETTING = 'replication_targets'
+MAX_CONCURRENT_REPLICATIONS_SETTING = 'max_concurrent_replications'
+REPLICATION_STATE_FILENAME = "replication-state.json"
 
 def elevate_if_needed(debug):
     ''' Not used if it's started w/ pyinstaller, since it does its own thing '''
@@ -94,6 +126,14 @@ def run():
     from .logutils import LogConfigurator
     from .monitor import ResticMonitor
     from .tray import ResticTray
+    from .reporter import FleetReporter
+    from .bandwidth import BandwidthPolicy
+    from .hooks import HookPipeline, HookCommand, StdinBackup
+    from .snapshot_index import SnapshotIndexer
+    from .history import RunHistory
+    from .profiler import ScanProfiler
+    from .verifier import RestoreVerifier
+    from .replication import Replicator, ReplicationTarget
     import filelock
 
     logger = logging.getLogger("main")
@@ -125,8 +165,80 @@ def run():
             import aiodebug.log_slow_callbacks
             aiodebug.log_slow_callbacks.enable(0.05)
 
-        monitor = ResticMonitor(app_dir=rootappdir, restic_exe=settings[RESTIC_EXE_SETTING], args=settings[ARGS_SETTING], env=env)
+        bounded_log_options = dict(
+            head_lines=int(settings.get(LOG_HEAD_LINES_SETTING, 200)),
+            tail_lines=int(settings.get(LOG_TAIL_LINES_SETTING, 200)),
+            max_error_lines=int(settings.get(LOG_MAX_ERROR_LINES_SETTING, 1000)),
+            checkpoint_seconds=int(settings.get(LOG_CHECKPOINT_SECONDS_SETTING, 60)),
+        )
+        bandwidth_policy = None
+        if settings.get(BANDWIDTH_PROFILES_SETTING):
+            bandwidth_policy = BandwidthPolicy.from_json(
+                settings[BANDWIDTH_PROFILES_SETTING],
+                min_change_ratio=float(settings.get(BANDWIDTH_MIN_CHANGE_RATIO_SETTING, 2.0)))
+        hooks = HookPipeline(
+            pre=[HookCommand.from_json(h) for h in settings.get(PRE_BACKUP_HOOKS_SETTING, [])],
+            post=[HookCommand.from_json(h) for h in settings.get(POST_BACKUP_HOOKS_SETTING, [])],
+            stdin_backups=[StdinBackup.from_json(b) for b in settings.get(STDIN_BACKUPS_SETTING, [])],
+            max_concurrent_stdin_backups=int(settings.get(MAX_CONCURRENT_STDIN_BACKUPS_SETTING, 2)))
+        history = RunHistory(os.path.join(rootappdir, RUN_HISTORY_FILENAME))
+        monitor = ResticMonitor(app_dir=rootappdir, 
+                                restic_exe=settings[RESTIC_EXE_SETTING], 
+                                args=settings[ARGS_SETTING], 
+                                env=env,
+                                log_mode=settings.get(LOG_MODE_SETTING, "full"),
+                                bounded_log_options=bounded_log_options,
+                                bandwidth_policy=bandwidth_policy,
+                                hooks=None if hooks.is_empty() else hooks,
+                                history=history)
+        if settings.get(SCAN_PROFILER_SETTING, False):
+            profiler = ScanProfiler(os.path.join(rootappdir, "logs", SCAN_PROFILE_FILENAME))
+            monitor.output_listeners.append(profiler.on_line)
+            monitor.start_listeners.append(profiler.reset)
+            monitor.run_listeners.append(profiler.on_run_finished)
+
+        reporter = None
+        if settings.get(REPORT_URL_SETTING):
+            import socket
+            reporter = FleetReporter(
+                url=settings[REPORT_URL_SETTING],
+                machine=settings.get(REPORT_MACHINE_SETTING) or socket.gethostname(),
+                outbox_filename=os.path.join(rootappdir, REPORT_OUTBOX_FILENAME),
+                token=settings.get(REPORT_TOKEN_SETTING),
+                heartbeat_seconds=int(settings.get(REPORT_HEARTBEAT_SECONDS_SETTING, 300))
+            )
         
+        indexer = None
+        if settings.get(SNAPSHOT_INDEX_SETTING, False):
+            indexer = SnapshotIndexer(
+                db_filename=os.path.join(rootappdir, SNAPSHOT_INDEX_FILENAME),
+                restic_exe=settings[RESTIC_EXE_SETTING],
+                env=env,
+                host=settings.get(SNAPSHOT_INDEX_HOST_SETTING))
+
+        verifier = None
+        if settings.get(RESTORE_VERIFICATION_SETTING, False):
+            verifier = RestoreVerifier(
+                restic_exe=settings[RESTIC_EXE_SETTING],
+                env=env,
+                history=history,
+                host=settings.get(SNAPSHOT_INDEX_HOST_SETTING),
+                interval_seconds=int(settings.get(RESTORE_VERIFICATION_INTERVAL_SECONDS_SETTING, 7 * 86400)),
+                max_files=int(settings.get(RESTORE_VERIFICATION_MAX_FILES_SETTING, 20)),
+                max_bytes=int(settings.get(RESTORE_VERIFICATION_MAX_BYTES_SETTING, 512 << 20)),
+                max_seconds=int(settings.get(RESTORE_VERIFICATION_MAX_SECONDS_SETTING, 900)),
+                workers=int(settings.get(RESTORE_VERIFICATION_WORKERS_SETTING, 4)))
+
+        replicator = None
+        if settings.get(REPLICATION_TARGETS_SETTING):
+            replicator = Replicator(
+                restic_exe=settings[RESTIC_EXE_SETTING],
+                env=env,
+                targets=[ReplicationTarget.from_json(t) for t in settings[REPLICATION_TARGETS_SETTING]],
+                state_filename=os.path.join(rootappdir, REPLICATION_STATE_FILENAME),
+                max_concurrent=int(settings.get(MAX_CONCURRENT_REPLICATIONS_SETTING, 1)))
+            monitor.run_listeners.append(replicator.on_run_finished)
+
         tray = ResticTray(
             monitor=monitor,
             min_idle_seconds=int(settings[MIN_IDLE_SECONDS_SETTING]),
@@ -134,7 +246,12 @@ def run():
             min_seconds_between_backups=int(settings[MIN_SECONDS_BETWEEN_BACKUPS_SETTING]),
             pause_until_filename=os.path.join(rootappdir, PAUSE_UNTIL_FILENAME),
             ignore_exit_code_3=bool(settings.get(IGNORE_EXIT_CODE_3_SETTING, False)),
-            app_log=os.path.join(rootappdir, "logs", "restic-monitor.log")
+            app_log=os.path.join(rootappdir, "logs", "restic-monitor.log"),
+            reporter=reporter,
+            cancel_on_activity=bool(settings.get(CANCEL_ON_ACTIVITY_SETTING, False)),
+            indexer=indexer,
+            verifier=verifier,
+            replicator=replicator
         )
         
         asyncio.run(tray.run_async())
@@ -5,17 +5,76 @@ import logging
 import os
 import time
 import asyncio
+import datetime
 from pathlib import Path
 from .lastline import get_last_line
+from .logsink import FullLogSink, BoundedLogSink
+from .bandwidth import BandwidthPolicy
+from .hooks import HookPipeline, HookRunner, HookCancelled, HOOK_FAILED_CODE
+from .history import RunHistory
+from .eta import EtaEstimator
+
+LOG_MODE_FULL = "full"
+LOG_MODE_BOUNDED = "bounded"
+
+# restic's global options, the ones in `args` that apply to the `restic backup --stdin` runs too
+GLOBAL_OPTIONS_WITH_VALUE = {
+    "-r", "--repo", "--repository-file", "-p", "--password-file", "--password-command", "--key-hint",
+    "-o", "--option", "--cacert", "--tls-client-cert", "--cache-dir", "--limit-upload", "--limit-download",
+    "--compression", "--pack-size", "--retry-lock",
+}
+GLOBAL_FLAGS = {
+    "--no-cache", "--cleanup-cache", "--no-lock", "--insecure-tls", "--no-extra-verify", "--json",
+    "-q", "--quiet", "-v", "-vv", "-vvv", "--verbose",
+}
+
+
+def global_restic_args(args):
+    " the global options in `args`, without the subcommand, its own options and the paths "
+    out = []
+    i = 0
+    while i < len(args):
+        a = args[i]
+        name = a.split("=", 1)[0]
+        if name in GLOBAL_OPTIONS_WITH_VALUE:
+            if "=" in a:
+                out.append(a)
+            else:
+                out += args[i:i + 2]
+                i += 1
+        elif name in GLOBAL_FLAGS:
+            out.append(a)
+        i += 1
+    return out
 
 class ResticMonitor:
-    def __init__(self, app_dir, restic_exe, args, env):
+    def __init__(self, app_dir, restic_exe, args, env, log_mode=LOG_MODE_FULL, bounded_log_options=None,
+                 bandwidth_policy: BandwidthPolicy = None, hooks: HookPipeline = None, history: RunHistory = None):
         self.app_dir = app_dir
         self.restic_exe = restic_exe
         self.args = args
         self.env = env
+        if log_mode not in (LOG_MODE_FULL, LOG_MODE_BOUNDED):
+            raise ValueError(f"Unknown log mode {log_mode}")
+        self.log_mode = log_mode
+        # keyword arguments for BoundedLogSink
+        self.bounded_log_options = bounded_log_options or {}
+        # the sink of the current (or the last) run in this process
+        self.log_sink = None
+        self.bandwidth_policy = bandwidth_policy
+        self.eta = EtaEstimator()
+        # callables that receive each line of the restic output, in the output thread
+        self.output_listeners = [self.eta.on_line]
+        # callables called every time restic starts, including the restarts for another bandwidth profile
+        self.start_listeners = []
+        self.history = history
+        self.hooks = hooks
         self.cancel_requested = False
         self.restic_proc: subprocess.Popen = None
+        # hooks, producers and `restic backup --stdin` processes of the current run
+        self.hook_procs = set()
+        # True from the first pre-backup hook until the last post-backup hook
+        self._run_in_progress = False
         self.lock = threading.RLock()
         self.logger = logging.getLogger("ResticMonitor")
         self.logger.setLevel(logging.DEBUG)
@@ -24,6 +83,10 @@ class ResticMonitor:
         self.logger.info(f"The following env vars are specified: {env.keys()}")
         self._last_run_code = None
         self._last_run_cancelled = False
+        # callables that receive the run record (a dict) after each run, in the event loop
+        self.run_listeners = []
+        if self.history:
+            self.run_listeners.append(self.history.add_run)
 
     def _restic_log_filename(self):
         return os.path.join(self.app_dir, "logs", "restic-last.log")
@@ -44,7 +107,7 @@ class ResticMonitor:
     def is_restic_running(self):
         " thread safe "
         with self.lock:
-            return self.restic_proc is not None
+            return self._run_in_progress
 
     def cancel_run(self):
         # " must be called from event loop"
@@ -52,46 +115,267 @@ class ResticMonitor:
             self.cancel_requested = True
             if self.restic_proc is not None:
                 self.restic_proc.kill()
+            for proc in self.hook_procs:
+                proc.kill()
     
+    def _kill_processes(self):
+        " must hold the lock, kills whatever is still running from the current run "
+        procs = list(self.hook_procs)
+        if self.restic_proc is not None:
+            procs.append(self.restic_proc)
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+
     def is_last_run_cancelled(self):
         with self.lock:
             return self._last_run_cancelled
 
+    def get_status(self):
+        " a json-friendly snapshot of the monitor state "
+        secs = self.seconds_since_last_successful_run()
+        with self.lock:
+            return {
+                "running": self._run_in_progress,
+                "last_run_code": self._last_run_code,
+                "last_run_cancelled": self._last_run_cancelled,
+                "last_success": None if secs is None else time.time() - secs,
+            }
+
+    def _notify_run_listeners(self, record):
+        for listener in self.run_listeners:
+            try:
+                listener(record)
+            except:
+                self.logger.error(f"Run listener {listener} failed", exc_info=1)
+
+    def get_progress_text(self):
+        " the progress of the running backup with its ETA, or None if there's no estimate "
+        with self.lock:
+            if self.restic_proc is None:
+                return None
+        return self.eta.progress_text()
+
     def get_restic_last_lines(self, lines=1):
+        with self.lock:
+            sink = self.log_sink
+        if sink is not None:
+            return sink.last_lines(lines)
         return get_last_line(self._restic_log_filename(), lines)
 
+    def _create_log_sink(self):
+        if self.log_mode == LOG_MODE_BOUNDED:
+            return BoundedLogSink(self._restic_log_filename(), **self.bounded_log_options)
+        return FullLogSink(self._restic_log_filename())
+
+    def _notify_output_listeners(self, line):
+        " a listener that fails on a line doesn't stop the output or the other listeners "
+        for listener in self.output_listeners:
+            try:
+                listener(line)
+            except:
+                self.logger.error(f"Output listener {listener} failed", exc_info=1)
+
+    def _pump_output(self, stream, sink):
+        " runs in its own thread until restic closes its stdout "
+        try:
+            for line in stream:
+                line = line.rstrip("\r\n")
+                sink.write(line)
+                self._notify_output_listeners(line)
+        except:
+            self.logger.error("Failed to read the restic output", exc_info=1)
+        finally:
+            stream.close()
+
+    def _start_restic(self, environ, bandwidth_profile, sink):
+        " must hold the lock "
+        args = self.args
+        if self.bandwidth_policy is not None:
+            args = self.bandwidth_policy.restic_args(args, bandwidth_profile)
+            self.logger.info(f"run_backup: using {bandwidth_profile}")
+        if self.history is not None:
+            self.eta.begin(self.history.profile_stats(bandwidth_profile.name if bandwidth_profile else None))
+        else:
+            self.eta.begin(None)
+        for listener in self.start_listeners:
+            try:
+                listener()
+            except:
+                self.logger.error(f"Start listener {listener} failed", exc_info=1)
+        self.restic_proc = Popen([self.restic_exe] + args, 
+                                 env=environ, 
+                                 stdout=subprocess.PIPE, 
+                                 stderr=subprocess.STDOUT, 
+                                 stdin=subprocess.DEVNULL,
+                                 encoding="utf-8",
+                                 errors="replace",
+                                 creationflags=subprocess.CREATE_NO_WINDOW)
+        pump = threading.Thread(target=self._pump_output, 
+                                args=(self.restic_proc.stdout, sink), 
+                                name="restic-output", 
+                                daemon=True)
+        pump.start()
+        return pump
+
+    def _bandwidth_profile_switch(self, current):
+        """
+        Returns the profile to restart restic with, or None to keep it running as is.
+        """
+        if self.bandwidth_policy is None:
+            return None
+        new = self.bandwidth_policy.profile_at(datetime.datetime.now())
+        if self.bandwidth_policy.should_restart(current, new):
+            return new
+        return None
+
+
+    def _spawn_hook(self, environ, command, extra_env=None, stdin=subprocess.DEVNULL, **kwargs):
+        " HookRunner.spawn "
+        if extra_env:
+            environ = dict(environ, **extra_env)
+        with self.lock:
+            if self.cancel_requested:
+                raise HookCancelled()
+            proc = Popen(command,
+                         env=environ,
+                         stdin=stdin,
+                         creationflags=subprocess.CREATE_NO_WINDOW,
+                         **kwargs)
+            self.hook_procs.add(proc)
+        return proc
+
+    def _stdin_backup_command(self, bandwidth_profile):
+        # the repository, password and other global options of the main backup, but not its paths
+        args = global_restic_args(self.args) + ["backup"]
+        if self.bandwidth_policy is not None:
+            args = self.bandwidth_policy.restic_args(args, bandwidth_profile)
+        return [self.restic_exe] + args
+
+    async def _run_restic_backup(self, environ, sink, onprogress):
+        """
+        The main `restic backup`. Returns the exit code, the bandwidth profile it finished with
+        and how many times it was restarted to switch the profile.
+        """
+        bandwidth_profile = None
+        if self.bandwidth_policy is not None:
+            bandwidth_profile = self.bandwidth_policy.profile_at(datetime.datetime.now())
+        restarts = 0
+        with self.lock:
+            pump = self._start_restic(environ, bandwidth_profile, sink)
+
+        while True:
+            while self.restic_proc.poll() is None:
+                self.logger.debug(f"run_backup: Waiting for restic to be done")
+                onprogress()
+                await asyncio.sleep(1)
+                switch_to = self._bandwidth_profile_switch(bandwidth_profile)
+                if switch_to is not None:
+                    break
+            else:
+                break
+            # crossed into another bandwidth profile, restart restic with the new limits
+            self.logger.info(f"run_backup: switching from {bandwidth_profile} to {switch_to}, restarting restic")
+            with self.lock:
+                self.restic_proc.kill()
+            await asyncio.get_running_loop().run_in_executor(None, pump.join)
+            await asyncio.get_running_loop().run_in_executor(None, self.restic_proc.wait)
+            with self.lock:
+                if self.cancel_requested:
+                    break
+                sink.write(f"[restic-monitor: switching to bandwidth profile {switch_to.name}, restarting restic]")
+                bandwidth_profile = switch_to
+                restarts += 1
+                pump = self._start_restic(environ, bandwidth_profile, sink)
+        
+        # drain whatever is left in the pipe without blocking the event loop
+        await asyncio.get_running_loop().run_in_executor(None, pump.join)
+        self.logger.info(f"run_backup: restic returned {self.restic_proc.returncode}")
+        with self.lock:
+            retval = self.restic_proc.returncode
+            self.restic_proc = None
+        return retval, bandwidth_profile, restarts
 
     async def run_backup(self, onprogress):
-        args = [self.restic_exe] + self.args
         environ_copy = os.environ.copy()
         environ_copy.update(self.env)
         
         self.logger.info(f"run_backup starting")
-        self.restic_logfile = open(self._restic_log_filename(), "w")
+        started = time.time()
+        sink = self._create_log_sink()
         with self.lock:
-            self.restic_proc = Popen(args, 
-                                     env=environ_copy, 
-                                     stdout=self.restic_logfile, 
-                                     stderr=self.restic_logfile, 
-                                     stdin=subprocess.DEVNULL,
-                                     creationflags=subprocess.CREATE_NO_WINDOW)
-
-        while self.restic_proc.poll() is None:
-            self.logger.debug(f"run_backup: Waiting for restic to be done")
-            onprogress()
-            await asyncio.sleep(1)
-        
-        self.restic_logfile.close()
-        
-        self.logger.info(f"run_backup: restic returned {self.restic_proc.returncode}")
+            self.log_sink = sink
+            self._run_in_progress = True
+        hooks = self.hooks or HookPipeline()
+        runner = HookRunner(lambda command, **kwargs: self._spawn_hook(environ_copy, command, **kwargs),
+                            sink,
+                            onprogress)
+        retval = None
+        bandwidth_profile = None
+        restarts = 0
+        hook_failures = []
+        backup_stats = {}
+        cancel_requested = False
+        try:
+            try:
+                hook_failures += await hooks.run_pre(runner)
+                if not hook_failures and not self.cancel_requested:
+                    retval, bandwidth_profile, restarts = await self._run_restic_backup(environ_copy, sink, onprogress)
+                    backup_stats = self.eta.run_stats()
+                if retval in (0, 3) and hooks.stdin_backups and not self.cancel_requested:
+                    hook_failures += await hooks.run_stdin_backups(runner, self._stdin_backup_command(bandwidth_profile))
+            except HookCancelled:
+                pass
+            except Exception as e:
+                # e.g. restic_exe doesn't exist, the run fails but the post hooks still run
+                self.logger.error("run_backup: the backup failed", exc_info=1)
+                with self.lock:
+                    self._kill_processes()
+                hook_failures.append(f"the backup failed: {e!r}")
+                retval = HOOK_FAILED_CODE
+            if retval is None or (hook_failures and retval in (0, 3)):
+                retval = HOOK_FAILED_CODE
+            # post-backup hooks run no matter what
+            with self.lock:
+                cancel_requested = self.cancel_requested
+                self.cancel_requested = False
+            try:
+                post_failures = await hooks.run_post(runner, retval)
+            except Exception as e:
+                self.logger.error("run_backup: the post-backup hooks failed", exc_info=1)
+                post_failures = [f"the post-backup hooks failed: {e!r}"]
+            if post_failures and retval in (0, 3):
+                retval = HOOK_FAILED_CODE
+            hook_failures += post_failures
 
-        if self.restic_proc.returncode == 0:
+            for failure in hook_failures:
+                self.logger.warning(f"run_backup: {failure}")
+                sink.write(f"[restic-monitor: {failure}]")
+        finally:
+            sink.close()
+            with self.lock:
+                # nothing is left running unless the run was interrupted, e.g. the task was cancelled
+                self._kill_processes()
+                self.restic_proc = None
+                self.hook_procs.clear()
+                cancelled = cancel_requested or self.cancel_requested
+                self._last_run_cancelled = cancelled
+                self.cancel_requested = False
+                self._last_run_code = HOOK_FAILED_CODE if retval is None else retval
+                self._run_in_progress = False
+
+        if retval == 0:
             Path(self._restic_successul_marker_filename()).touch()
-        with self.lock:
-            cancelled = self.cancel_requested
-            self._last_run_cancelled = cancelled
-            self.cancel_requested = False
-            retval = self.restic_proc.returncode
-            self._last_run_code = self.restic_proc.returncode
-            self.restic_proc = None
+        finished = time.time()
+        self._notify_run_listeners({
+            "started": started,
+            "finished": finished,
+            "duration_seconds": finished - started,
+            "code": retval,
+            "cancelled": cancelled,
+            "bandwidth_profile": bandwidth_profile.name if bandwidth_profile else None,
+            "restarts": restarts,
+            "hook_failures": hook_failures,
+            **backup_stats,
+        })
         return (retval, cancelled)
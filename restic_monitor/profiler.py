@@ -0,0 +1,166 @@
+import json
+import logging
+import re
+import threading
+import time
+
+NEW = "new"
+MODIFIED = "modified"
+UNCHANGED = "unchanged"
+
+# `restic backup -vv` prints e.g. "modified  C:\Users\me\a.txt, saved in 0.012s (1.234 KiB added, 1.100 KiB stored)"
+VERBOSE_LINE = re.compile(r"^(new|modified|unchanged)\s+(.+?)(?:, saved in ([\d.]+)s \(([\d.]+ \w+) added.*\))?$")
+UNITS = {"B": 1, "KiB": 1 << 10, "MiB": 1 << 20, "GiB": 1 << 30, "TiB": 1 << 40}
+
+
+def _parse_size(value):
+    number, unit = value.split(" ")
+    return int(float(number) * UNITS.get(unit, 1))
+
+
+class DirStats:
+    __slots__ = ["children", "files", "bytes", "new", "changed", "seconds"]
+
+    def __init__(self):
+        self.children = {}
+        self.files = 0
+        self.bytes = 0
+        self.new = 0
+        self.changed = 0
+        self.seconds = 0.0
+
+
+class ScanProfiler:
+    """
+    Attributes the time of a backup to directories, from the per-file lines of
+    `restic backup -vv` (or the verbose_status messages of `--json -vv`).
+
+    Every file adds to its directory and all the ancestors: files scanned, bytes (read with --json,
+    added to the repository otherwise), new and changed files and elapsed time. The elapsed time
+    of an item is the wall time since the previous item, which covers reading unchanged files too.
+
+    The tree is bounded: it's at most `max_depth` deep and has at most `max_nodes` directories,
+    beyond which a file counts towards its deepest tracked ancestor.
+    """
+    def __init__(self, report_filename, max_depth=12, max_nodes=100000, top=30):
+        self.report_filename = report_filename
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.top = top
+        self.logger = logging.getLogger("ScanProfiler")
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        " start listener for ResticMonitor too: a restarted restic scans everything again "
+        with self.lock:
+            self.root = DirStats()
+            self.nodes = 1
+            self.last_item_time = None
+
+    def _item(self, line):
+        " returns (action, path, bytes) or None "
+        if line.startswith("{"):
+            if '"message_type":"verbose_status"' not in line:
+                return None
+            try:
+                message = json.loads(line)
+            except ValueError:
+                return None
+            if message.get("action") not in (NEW, MODIFIED, UNCHANGED):
+                return None
+            return message["action"], message.get("item", ""), message.get("data_size", 0)
+        m = VERBOSE_LINE.match(line)
+        if m is None:
+            return None
+        return m.group(1), m.group(2), _parse_size(m.group(4)) if m.group(4) else 0
+
+    def on_line(self, line: str):
+        item = self._item(line)
+        if item is None:
+            return
+        action, path, size = item
+        now = time.monotonic()
+        is_dir = path.endswith(("/", "\\"))
+        parts = [p for p in path.replace("\\", "/").split("/") if p]
+        if not is_dir:
+            parts = parts[:-1]
+        with self.lock:
+            elapsed = 0.0 if self.last_item_time is None else now - self.last_item_time
+            self.last_item_time = now
+            node = self.root
+            chain = [node]
+            for part in parts[:self.max_depth]:
+                child = node.children.get(part)
+                if child is None:
+                    if self.nodes >= self.max_nodes:
+                        break
+                    child = node.children[part] = DirStats()
+                    self.nodes += 1
+                node = child
+                chain.append(node)
+            for n in chain:
+                n.seconds += elapsed
+                if not is_dir:
+                    n.files += 1
+                    n.bytes += size
+                    if action == NEW:
+                        n.new += 1
+                    elif action == MODIFIED:
+                        n.changed += 1
+
+    def _flatten(self):
+        " must hold the lock, (path, depth, stats) of every directory "
+        out = []
+        stack = [("", 0, self.root)]
+        while stack:
+            path, depth, node = stack.pop()
+            if depth > 0:
+                out.append((path, depth, node))
+            for name, child in node.children.items():
+                stack.append((f"{path}/{name}" if path else name, depth + 1, child))
+        return out
+
+    def _table(self, title, rows):
+        lines = [title, f"{'seconds':>10} {'files':>10} {'new':>8} {'changed':>8} {'MiB':>10}  directory"]
+        for path, _, n in rows:
+            lines.append(f"{n.seconds:>10.1f} {n.files:>10} {n.new:>8} {n.changed:>8} {n.bytes / (1 << 20):>10.1f}  {path}")
+        return "\n".join(lines)
+
+    def report(self):
+        with self.lock:
+            dirs = self._flatten()
+            total = self.root
+        if not dirs:
+            return None
+        # a directory whose only child accounts for all its time would repeat the same line
+        def informative(entry):
+            _, _, n = entry
+            return all(c.seconds < n.seconds or c.files < n.files for c in n.children.values())
+        dirs = [d for d in dirs if informative(d)]
+        slowest = sorted(dirs, key=lambda d: d[2].seconds, reverse=True)[:self.top]
+        # time spent on directories where (almost) nothing changed is time that excludes would save
+        def wasted(entry):
+            _, _, n = entry
+            unchanged = n.files - n.new - n.changed
+            return n.seconds * unchanged / n.files if n.files else 0
+        least_changing = sorted([d for d in dirs if d[2].files], key=wasted, reverse=True)[:self.top]
+        header = (f"Scan profile: {total.files} files, {total.new} new, {total.changed} changed, "
+                  f"{total.seconds:.1f}s in {self.nodes} directories tracked")
+        return "\n\n".join([
+            header,
+            self._table("Slowest directories", slowest),
+            self._table("Least changing directories, by time spent on unchanged files", least_changing),
+        ]) + "\n"
+
+    def on_run_finished(self, record: dict):
+        " run listener for ResticMonitor: writes the report and starts over "
+        try:
+            content = self.report()
+            if content:
+                with open(self.report_filename, "w", encoding="utf-8") as f:
+                    f.write(content)
+                self.logger.info(f"Wrote the scan profile to {self.report_filename}")
+        except:
+            self.logger.warn(f"Failed to write {self.report_filename}", exc_info=1)
+        self.reset()
@@ -0,0 +1,241 @@
+"""
+Copies the snapshots of the main repository to secondary repositories with `restic copy`.
+
+Replicate to a local directory right away, or see how far behind the targets are:
+
+    py -m restic_monitor.replication run
+    py -m restic_monitor.replication status
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .background import BackgroundWorker, WorkCancelled
+from .bandwidth import BandwidthPolicy
+
+# `restic copy --from-repo` reads the source repository from these
+FROM_VARIABLES = {
+    "RESTIC_REPOSITORY": "RESTIC_FROM_REPOSITORY",
+    "RESTIC_REPOSITORY_FILE": "RESTIC_FROM_REPOSITORY_FILE",
+    "RESTIC_PASSWORD": "RESTIC_FROM_PASSWORD",
+    "RESTIC_PASSWORD_FILE": "RESTIC_FROM_PASSWORD_FILE",
+    "RESTIC_PASSWORD_COMMAND": "RESTIC_FROM_PASSWORD_COMMAND",
+}
+
+
+class ReplicationCancelled(WorkCancelled):
+    pass
+
+
+class ReplicationTarget:
+    " a secondary repository, `env` has its RESTIC_REPOSITORY and password "
+    def __init__(self, name, env: dict, args=None, bandwidth_policy: BandwidthPolicy = None, batch_size=10):
+        self.name = name
+        self.env = env
+        self.args = args or []
+        self.bandwidth_policy = bandwidth_policy
+        self.batch_size = batch_size
+
+    @staticmethod
+    def from_json(value: dict):
+        policy = None
+        if value.get("bandwidth_profiles"):
+            policy = BandwidthPolicy.from_json(value["bandwidth_profiles"])
+        return ReplicationTarget(value["name"], value["env"], value.get("args"), policy, int(value.get("batch_size", 10)))
+
+
+class Replicator(BackgroundWorker):
+    """
+    Copies the snapshots of the main repository that are missing in each target, oldest first,
+    `batch_size` snapshots per `restic copy`. Up to `max_concurrent` targets are copied to at a time.
+
+    A cursor per target, the snapshots already copied, is persisted after every batch, so an
+    interrupted replication resumes where it stopped and the snapshots that are already there
+    aren't listed again. An empty cursor, for a new target or a lost state file, is seeded from
+    the snapshots of the target. The bandwidth profile of a target is picked for each batch.
+
+    Runs after every successful backup, and every `check_seconds` to retry, while `should_run()` says so.
+    """
+    Cancelled = ReplicationCancelled
+
+    def __init__(self, restic_exe, env, targets: list, state_filename, max_concurrent=1, check_seconds=3600):
+        super().__init__(restic_exe, env, check_seconds=check_seconds)
+        self.targets = targets
+        self.state_filename = state_filename
+        self.max_concurrent = max_concurrent
+        self.state = self._load()
+
+    def _load(self):
+        try:
+            if os.path.exists(self.state_filename):
+                with open(self.state_filename, "r") as f:
+                    return json.loads(f.read())
+        except:
+            self.logger.warn(f"Failed to read {self.state_filename}", exc_info=1)
+        return {}
+
+    def _save(self):
+        " must hold the lock "
+        tmp_filename = self.state_filename + ".tmp"
+        try:
+            with open(tmp_filename, "w") as f:
+                f.write(json.dumps(self.state))
+            os.replace(tmp_filename, self.state_filename)
+        except:
+            self.logger.warn(f"Failed to persist the replication state to {self.state_filename}", exc_info=1)
+
+    def _update_state(self, target: ReplicationTarget, **values):
+        with self.lock:
+            self.state.setdefault(target.name, {"copied": []}).update(values)
+            self._save()
+
+    def _copy_environ(self, target: ReplicationTarget):
+        " the main repository as the source, the target as the repository "
+        environ = self._environ()
+        for name, from_name in FROM_VARIABLES.items():
+            environ.pop(name, None)
+            environ.pop(from_name, None)
+            if name in self.env:
+                environ[from_name] = self.env[name]
+        environ.update(target.env)
+        return environ
+
+    def _list_snapshots(self):
+        code, out = self._restic(["snapshots", "--json"])
+        if code != 0:
+            raise Exception(f"restic snapshots failed with code {code}: {out[-500:]}")
+        return sorted(json.loads(out or "[]"), key=lambda s: s["time"])
+
+    def _seed_cursor(self, target: ReplicationTarget, snapshots):
+        """
+        The snapshots of the main repository that are already in the target. `restic copy`
+        records the id of the first snapshot in the chain as `original`.
+        """
+        code, out = self._restic(["snapshots", "--json"], self._copy_environ(target))
+        if code != 0:
+            # restic copy skips the snapshots that are already there anyway
+            self.logger.warn(f"Failed to list the snapshots of {target.name}, code {code}: {out[-500:]}")
+            return []
+        originals = set(s.get("original", s["id"]) for s in json.loads(out or "[]"))
+        return [s["id"] for s in snapshots if s.get("original", s["id"]) in originals]
+
+    def _copy_command(self, target: ReplicationTarget, ids):
+        args = ["copy"] + target.args + ids
+        if target.bandwidth_policy is not None:
+            profile = target.bandwidth_policy.profile_at(datetime.datetime.now())
+            args = target.bandwidth_policy.restic_args(args, profile)
+        return args
+
+    def _pending_state(self, pending):
+        return {
+            "pending": len(pending),
+            "oldest_pending": pending[0]["time"] if pending else None,
+        }
+
+    def _replicate_target(self, target: ReplicationTarget, snapshots):
+        source_ids = set(s["id"] for s in snapshots)
+        with self.lock:
+            cursor = self.state.get(target.name, {}).get("copied", [])
+            # snapshots forgotten in the main repository don't need to be tracked anymore
+            copied = [i for i in cursor if i in source_ids]
+        if not copied:
+            copied = self._seed_cursor(target, snapshots)
+        done = set(copied)
+        pending = [s for s in snapshots if s["id"] not in done]
+        self._update_state(target, copied=copied, last_attempt=datetime.datetime.now().isoformat(),
+                           **self._pending_state(pending))
+        environ = self._copy_environ(target)
+        while pending:
+            batch = pending[:target.batch_size]
+            ids = [s["id"] for s in batch]
+            code, out = self._restic(self._copy_command(target, ids), environ)
+            if code != 0:
+                lines = [l for l in out.splitlines() if l.strip()]
+                error = f"restic copy failed with code {code}: {' '.join(lines[-2:])}"
+                self.logger.error(f"Replication to {target.name}: {error}")
+                self._update_state(target, last_error=error)
+                return
+            copied += ids
+            pending = pending[len(batch):]
+            self.logger.info(f"Copied {len(ids)} snapshots to {target.name}, {len(pending)} left")
+            self._update_state(target, copied=copied, **self._pending_state(pending))
+        self._update_state(target, last_error=None, last_success=datetime.datetime.now().isoformat())
+
+    def replicate(self):
+        " blocking, brings every target up to date "
+        self._begin()
+        snapshots = self._list_snapshots()
+        with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+            results = [executor.submit(self._replicate_target, t, snapshots) for t in self.targets]
+        for r in results:
+            # raises ReplicationCancelled, or anything unexpected
+            r.result()
+
+    def lag(self, now: datetime.datetime = None):
+        """
+        For each target: the number of snapshots not copied yet, the age of the oldest one,
+        and the last success and error. The counts are as of the last replication.
+        """
+        now = now or datetime.datetime.now()
+        status = {}
+        with self.lock:
+            for target in self.targets:
+                state = self.state.get(target.name, {})
+                lag_seconds = None
+                if state.get("oldest_pending"):
+                    oldest = datetime.datetime.fromisoformat(state["oldest_pending"]).astimezone()
+                    lag_seconds = max((now.astimezone() - oldest).total_seconds(), 0)
+                elif "pending" in state:
+                    lag_seconds = 0
+                status[target.name] = {
+                    "pending": state.get("pending"),
+                    "lag_seconds": lag_seconds,
+                    "last_success": state.get("last_success"),
+                    "last_error": state.get("last_error"),
+                }
+        return status
+
+    def work(self):
+        self.replicate()
+
+    def on_run_finished(self, record: dict):
+        " run listener for ResticMonitor "
+        if record.get("code") in (0, 3) and not record.get("cancelled"):
+            self.wake_up()
+
+
+def run():
+    from .appdir import get_appdir
+    from .main import APP_NAME, SETTINGS_FILENAME, ENV_FILENAME, RESTIC_EXE_SETTING, \
+        REPLICATION_TARGETS_SETTING, MAX_CONCURRENT_REPLICATIONS_SETTING, REPLICATION_STATE_FILENAME
+
+    parser = argparse.ArgumentParser(description="copy the snapshots to the replication targets")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("run", help="replicate now")
+    sub.add_parser("status", help="show how far behind the targets are")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] (%(name)s): %(message)s")
+    appdir = get_appdir(APP_NAME)
+    with open(os.path.join(appdir, SETTINGS_FILENAME)) as f:
+        settings = json.loads(f.read())
+    with open(os.path.join(appdir, ENV_FILENAME)) as f:
+        env = json.loads(f.read())
+    replicator = Replicator(
+        restic_exe=settings[RESTIC_EXE_SETTING],
+        env=env,
+        targets=[ReplicationTarget.from_json(t) for t in settings.get(REPLICATION_TARGETS_SETTING, [])],
+        state_filename=os.path.join(appdir, REPLICATION_STATE_FILENAME),
+        max_concurrent=int(settings.get(MAX_CONCURRENT_REPLICATIONS_SETTING, 1)))
+    if args.command == "run":
+        replicator.replicate()
+    for name, lag in replicator.lag().items():
+        print(f"{name}: {lag['pending']} snapshots behind, lag {lag['lag_seconds']}s, "
+              f"last success {lag['last_success']}, last error {lag['last_error']}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,158 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.request
+
+RUN_RECORD = "run"
+HEARTBEAT_RECORD = "heartbeat"
+
+
+class FleetReporter:
+    """
+    Pushes run records and heartbeats to a fleet collector (see collector.py).
+
+    Records are queued in an outbox that is persisted to `outbox_filename`, so nothing
+    is lost while the machine is offline or restarted. Only the latest heartbeat is kept
+    in the outbox since older ones carry no information. The outbox is sent in gzipped
+    batches of up to `batch_size` records, with exponential backoff on failures.
+    """
+    def __init__(self,
+                 url: str,
+                 machine: str,
+                 outbox_filename: str,
+                 token: str = None,
+                 batch_size=100,
+                 heartbeat_seconds=300,
+                 max_outbox_records=10000,
+                 max_backoff_seconds=3600,
+                 timeout_seconds=30):
+        self.url = url
+        self.machine = machine
+        self.outbox_filename = outbox_filename
+        self.token = token
+        self.batch_size = batch_size
+        self.heartbeat_seconds = heartbeat_seconds
+        self.max_outbox_records = max_outbox_records
+        self.max_backoff_seconds = max_backoff_seconds
+        self.timeout_seconds = timeout_seconds
+        self.logger = logging.getLogger("FleetReporter")
+        self.logger.setLevel(logging.DEBUG)
+        self.lock = threading.RLock()
+        self.outbox = self._load_outbox()
+        self.failures = 0
+        # set when there is something worth sending right away
+        self.wakeup_event = asyncio.Event()
+
+    def _load_outbox(self):
+        try:
+            if os.path.exists(self.outbox_filename):
+                with open(self.outbox_filename, "r") as f:
+                    return json.loads(f.read())
+        except:
+            self.logger.warn(f"Failed to read {self.outbox_filename}", exc_info=1)
+        return []
+
+    def _save_outbox(self):
+        " must hold the lock "
+        tmp_filename = self.outbox_filename + ".tmp"
+        try:
+            with open(tmp_filename, "w") as f:
+                f.write(json.dumps(self.outbox))
+            os.replace(tmp_filename, self.outbox_filename)
+        except:
+            self.logger.warn(f"Failed to persist the outbox to {self.outbox_filename}", exc_info=1)
+
+    def add(self, record: dict):
+        with self.lock:
+            if record["type"] == HEARTBEAT_RECORD:
+                self.outbox = [r for r in self.outbox if r["type"] != HEARTBEAT_RECORD]
+            self.outbox.append(record)
+            if len(self.outbox) > self.max_outbox_records:
+                dropped = len(self.outbox) - self.max_outbox_records
+                self.logger.warn(f"Outbox is full, dropping {dropped} oldest records")
+                self.outbox = self.outbox[dropped:]
+            self._save_outbox()
+
+    def on_run_finished(self, record: dict):
+        " run listener for ResticMonitor, called from the event loop "
+        self.add(dict(record, type=RUN_RECORD))
+        self.wakeup_event.set()
+
+    def _post(self, batch):
+        " blocking, runs in the executor "
+        body = gzip.compress(json.dumps({"machine": self.machine, "records": batch}).encode("utf-8"))
+        request = urllib.request.Request(self.url, data=body, method="POST")
+        request.add_header("Content-Type", "application/json")
+        request.add_header("Content-Encoding", "gzip")
+        if self.token:
+            request.add_header("Authorization", f"Bearer {self.token}")
+        with urllib.request.urlopen(request, timeout=self.timeout_seconds) as response:
+            response.read()
+
+    async def flush(self):
+        """
+        Sends the outbox in batches. Returns False if a batch failed to send.
+        """
+        while True:
+            with self.lock:
+                batch = self.outbox[:self.batch_size]
+            if not batch:
+                return True
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._post, batch)
+            except Exception as e:
+                self.logger.info(f"Failed to send {len(batch)} records to {self.url}: {e}")
+                return False
+            with self.lock:
+                # records may have been added or a heartbeat replaced while sending
+                sent = set(id(r) for r in batch)
+                self.outbox = [r for r in self.outbox if id(r) not in sent]
+                self._save_outbox()
+            self.logger.debug(f"Sent {len(batch)} records to {self.url}")
+
+    def _backoff_seconds(self):
+        backoff = min(self.max_backoff_seconds, 10 * 2 ** min(self.failures, 16))
+        return backoff * random.uniform(0.5, 1.0)
+
+    async def run(self, status_fn, should_quit):
+        """
+        Main loop of the reporter. `status_fn` returns the heartbeat status dict,
+        `should_quit` returns True when the app is shutting down.
+        """
+        self.logger.info(f"FleetReporter is running, reporting as {self.machine} to {self.url}")
+        next_heartbeat = 0
+        # send whatever is left in the outbox from the previous session right away
+        next_attempt = 0
+        while not should_quit():
+            try:
+                now = time.monotonic()
+                # while backing off, new records wait for the next attempt
+                due = now >= next_attempt
+                if now >= next_heartbeat:
+                    self.add(dict(status_fn(), type=HEARTBEAT_RECORD, time=time.time()))
+                    next_heartbeat = now + self.heartbeat_seconds
+                    due = due or self.failures == 0
+                if self.wakeup_event.is_set():
+                    self.wakeup_event.clear()
+                    due = due or self.failures == 0
+                if due:
+                    if await self.flush():
+                        self.failures = 0
+                        next_attempt = float("inf")
+                    else:
+                        self.failures += 1
+                        next_attempt = time.monotonic() + self._backoff_seconds()
+                wait_time = min(next_heartbeat, next_attempt) - time.monotonic()
+                try:
+                    await asyncio.wait_for(self.wakeup_event.wait(), timeout=max(wait_time, 1))
+                except asyncio.TimeoutError:
+                    pass
+            except:
+                self.logger.error("Exception in FleetReporter.run", exc_info=1)
+                await asyncio.sleep(10)
+        self.logger.info("FleetReporter quit")
@@ -0,0 +1,82 @@
+import asyncio
+import datetime
+
+RUN = "run"
+WAIT = "wait"
+
+
+class SystemClock:
+    " the wall clock, used by the tray "
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.now()
+
+    def sleep(self, seconds):
+        return asyncio.sleep(seconds)
+
+
+class BackupScheduler:
+    """
+    The scheduling of ResticTray.main_tray_loop, without the tray. The wall clock and the
+    idle time source are passed in, so the same code can be simulated (see simulator.py).
+    """
+    # while paused, re-evaluate at least this often just in case
+    MAX_PAUSE_WAIT_SECONDS = 3600
+    # when it's time to run but a backup is still running
+    ALREADY_RUNNING_WAIT_SECONDS = 10
+    # how often a running backup checks whether the user is back
+    ACTIVITY_CHECK_SECONDS = 1
+
+    def __init__(self, min_idle_seconds, min_seconds_between_backups, cancel_on_activity=False):
+        self.min_idle_seconds = min_idle_seconds
+        self.min_seconds_between_backups = min_seconds_between_backups
+        # stop a running backup as soon as the user comes back
+        self.cancel_on_activity = cancel_on_activity
+
+    def is_paused(self, now: datetime.datetime, pause_until: datetime.datetime):
+        return pause_until is not None and now <= pause_until
+
+    def next_action(self, now: datetime.datetime, idle_time, pause_until: datetime.datetime, run_requested):
+        """
+        Returns (RUN, seconds to wait after the backup) or (WAIT, seconds to wait).
+        The wait may be cut short by a wake up, e.g. when the user requests a run.
+        """
+        if self.is_paused(now, pause_until):
+            return WAIT, min((pause_until - now).total_seconds(), BackupScheduler.MAX_PAUSE_WAIT_SECONDS)
+        elif idle_time > self.min_idle_seconds or run_requested:
+            return RUN, self.min_seconds_between_backups
+        else:
+            return WAIT, max(0, self.min_idle_seconds - idle_time)
+
+    def should_cancel(self, idle_time, run_requested):
+        """
+        Whether a running backup should be stopped because the user is back.
+        Backups the user asked for are never stopped.
+        """
+        return self.cancel_on_activity and not run_requested and idle_time < self.min_idle_seconds
+
+    async def step(self, clock, idle_source, pause_until: datetime.datetime, run_requested, is_running, run_backup):
+        """
+        One iteration of the main loop. Awaits `run_backup(run_requested)` if it's time for a backup,
+        and returns the seconds to wait before the next iteration. The wait may be cut short by a wake up.
+        """
+        action, wait_time = self.next_action(clock.now(), idle_source(), pause_until, run_requested)
+        if action != RUN:
+            return wait_time
+        if is_running():
+            return BackupScheduler.ALREADY_RUNNING_WAIT_SECONDS
+        await run_backup(run_requested)
+        return wait_time
+
+    async def watch_backup(self, clock, idle_source, run_requested, is_running, cancel):
+        """
+        Calls `cancel()` once the user is back while `is_running()`, see should_cancel.
+        Returns whether it cancelled the backup. Returns right away if the backup can't be cancelled.
+        """
+        if not self.cancel_on_activity or run_requested:
+            return False
+        while is_running():
+            if self.should_cancel(idle_source(), run_requested):
+                cancel()
+                return True
+            await clock.sleep(BackupScheduler.ACTIVITY_CHECK_SECONDS)
+        return False
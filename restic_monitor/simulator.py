@@ -0,0 +1,286 @@
+"""
+Replays idle traces through BackupScheduler on a virtual clock, so that scheduling
+policies can be compared over weeks of activity in a fraction of a second.
+
+Record a trace of this machine (one sample per `--interval` seconds, until Ctrl+C):
+
+    py -m restic_monitor.simulator record --out idle.jsonl
+
+Compare policies over the recorded trace, or over a synthetic one:
+
+    py -m restic_monitor.simulator simulate --trace idle.jsonl --policy 300,900 --policy 600,3600,cancel
+    py -m restic_monitor.simulator simulate --synthetic-days 28 --policy 300,900 --policy 120,900,cancel
+
+A policy is `min_idle_seconds,min_seconds_between_backups[,cancel]`, `cancel` being cancel_on_activity.
+"""
+import argparse
+import asyncio
+import bisect
+import datetime
+import json
+import random
+import time
+
+from .scheduler import BackupScheduler
+
+
+class VirtualClock:
+    " a clock that only moves when told to "
+    def __init__(self, start: datetime.datetime):
+        self.start = start
+        self.seconds = 0.0
+
+    def now(self):
+        return self.start + datetime.timedelta(seconds=self.seconds)
+
+    def advance(self, seconds):
+        self.seconds += seconds
+
+    async def sleep(self, seconds):
+        " like SystemClock.sleep, but the time passes right away "
+        self.advance(seconds)
+
+
+class ActivityTrace:
+    """
+    The periods the user was active, as sorted, non-overlapping (start, end) seconds
+    from the beginning of the trace. The user is considered idle since the beginning
+    of the trace until the first activity.
+    """
+    def __init__(self, intervals, length_seconds):
+        self.starts = [s for s, _ in intervals]
+        self.ends = [e for _, e in intervals]
+        self.length_seconds = length_seconds
+        # active seconds before each interval, for overlap queries
+        self.active_before = [0.0]
+        for s, e in intervals:
+            self.active_before.append(self.active_before[-1] + e - s)
+
+    def idle_time(self, t):
+        i = bisect.bisect_right(self.starts, t) - 1
+        if i < 0:
+            return t
+        if t < self.ends[i]:
+            return 0.0
+        return t - self.ends[i]
+
+    def next_activity(self, t):
+        " the time the user is next active at or after `t`, or None "
+        i = bisect.bisect_right(self.starts, t) - 1
+        if i >= 0 and t < self.ends[i]:
+            return t
+        if i + 1 < len(self.starts):
+            return self.starts[i + 1]
+        return None
+
+    def _active_until(self, t):
+        i = bisect.bisect_right(self.starts, t) - 1
+        if i < 0:
+            return 0.0
+        return self.active_before[i] + min(t, self.ends[i]) - self.starts[i]
+
+    def active_seconds(self, start, end):
+        return self._active_until(end) - self._active_until(start)
+
+    @staticmethod
+    def from_idle_samples(samples, gap_seconds):
+        """
+        Builds a trace from (seconds, idle time) samples as written by `record`.
+        Each sample means the user was last active at `seconds - idle time`; activity
+        points closer together than `gap_seconds` are merged into a single interval.
+        """
+        intervals = []
+        for t, idle in samples:
+            last_input = t - idle
+            if intervals and last_input <= intervals[-1][1] + gap_seconds:
+                intervals[-1][1] = max(intervals[-1][1], last_input)
+            else:
+                intervals.append([last_input, last_input])
+        length = samples[-1][0] if samples else 0
+        return ActivityTrace([(s, e) for s, e in intervals], length)
+
+    @staticmethod
+    def load(filename, gap_seconds):
+        with open(filename) as f:
+            samples = [json.loads(line) for line in f if line.strip()]
+        t0 = samples[0]["time"] if samples else 0
+        start = datetime.datetime.fromtimestamp(t0)
+        return start, ActivityTrace.from_idle_samples([(s["time"] - t0, s["idle"]) for s in samples], gap_seconds)
+
+    @staticmethod
+    def synthetic(days, rng: random.Random):
+        """
+        An office worker: active in bursts from around 9 to 18 on weekdays with a lunch break,
+        sometimes in the evening and on weekends.
+        """
+        intervals = []
+        for day in range(days):
+            base = day * 86400
+            weekend = day % 7 >= 5
+            sessions = []
+            if not weekend:
+                sessions += [(9 * 3600 + rng.gauss(0, 1200), 12 * 3600), (13 * 3600, 18 * 3600 + rng.gauss(0, 1800))]
+            if rng.random() < (0.6 if weekend else 0.4):
+                evening = rng.uniform(19, 22) * 3600
+                sessions.append((evening, evening + rng.uniform(0.5, 2.5) * 3600))
+            for start, end in sessions:
+                t = start
+                while t < end:
+                    burst = rng.expovariate(1 / 900)
+                    intervals.append((base + t, base + min(t + burst, end)))
+                    # short breaks, sometimes long enough to trigger a backup
+                    t += burst + rng.expovariate(1 / 240)
+        return ActivityTrace(intervals, days * 86400)
+
+
+class SimulationResult:
+    def __init__(self, name):
+        self.name = name
+        self.completed = 0
+        self.cancelled = 0
+        self.backup_seconds = 0.0
+        self.overlap_seconds = 0.0
+        self.seconds_past_warning = 0.0
+        self.decisions = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def simulate(name, scheduler: BackupScheduler, trace: ActivityTrace, start: datetime.datetime,
+             backup_duration, no_backup_warning_seconds, run_requests=(), pauses=()):
+    """
+    Runs the main_tray_loop iterations (BackupScheduler.step and watch_backup) over the trace on a
+    VirtualClock. `backup_duration()` returns the duration of the next backup. `run_requests` are the
+    times "Run now" is clicked, `pauses` the (start, end) times paused, which also stops a running backup.
+    The last successful backup is assumed to have happened at the start of the trace.
+    """
+    return asyncio.run(_simulate(name, scheduler, trace, start, backup_duration, no_backup_warning_seconds,
+                                 sorted(run_requests), sorted(pauses)))
+
+
+async def _simulate(name, scheduler, trace, start, backup_duration, no_backup_warning_seconds, run_requests, pauses):
+    result = SimulationResult(name)
+    clock = VirtualClock(start)
+    last_success = 0.0
+    # like ResticTray.run_requested
+    run_requested = False
+    next_request = 0
+
+    def idle_source():
+        return trace.idle_time(clock.seconds)
+
+    def pause_until(t):
+        for s, e in pauses:
+            if s <= t < e:
+                return start + datetime.timedelta(seconds=e)
+        return None
+
+    def next_pause(t):
+        return next((s for s, _ in pauses if s > t), None)
+
+    def account_success(t):
+        nonlocal last_success
+        result.seconds_past_warning += max(0.0, t - last_success - no_backup_warning_seconds)
+        last_success = t
+
+    async def run_backup(requested):
+        nonlocal run_requested
+        run_requested = False
+        t = clock.seconds
+        end = t + backup_duration()
+        pause = next_pause(t)
+        paused = pause is not None and pause < end
+        if paused:
+            end = pause
+        cancelled = False
+
+        def cancel():
+            nonlocal cancelled
+            cancelled = True
+        await scheduler.watch_backup(clock, idle_source, requested, lambda: clock.seconds < end and not cancelled, cancel)
+        if clock.seconds < end and not cancelled:
+            clock.advance(end - clock.seconds)
+        cancelled = cancelled or paused
+        result.backup_seconds += clock.seconds - t
+        result.overlap_seconds += trace.active_seconds(t, clock.seconds)
+        if cancelled:
+            result.cancelled += 1
+        else:
+            result.completed += 1
+            account_success(clock.seconds)
+
+    while clock.seconds < trace.length_seconds:
+        while next_request < len(run_requests) and run_requests[next_request] <= clock.seconds:
+            run_requested = True
+            next_request += 1
+        result.decisions += 1
+        wait_time = await scheduler.step(clock, idle_source, pause_until(clock.seconds), run_requested,
+                                         lambda: False, run_backup)
+        # "Run now" wakes the tray up
+        if next_request < len(run_requests):
+            wait_time = min(wait_time, run_requests[next_request] - clock.seconds)
+        await clock.sleep(max(wait_time, 0.001))
+    account_success(max(trace.length_seconds, last_success))
+    return result
+
+
+def parse_policy(value):
+    parts = value.split(",")
+    return BackupScheduler(min_idle_seconds=int(parts[0]),
+                           min_seconds_between_backups=int(parts[1]),
+                           cancel_on_activity=len(parts) > 2 and parts[2] == "cancel")
+
+
+def record(out, interval):
+    from .idle import get_idle_time
+    with open(out, "a") as f:
+        try:
+            while True:
+                f.write(json.dumps({"time": time.time(), "idle": get_idle_time()}) + "\n")
+                f.flush()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+
+def run():
+    parser = argparse.ArgumentParser(description="restic-monitor scheduling simulator")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rec = sub.add_parser("record", help="record the idle time of this machine")
+    rec.add_argument("--out", required=True)
+    rec.add_argument("--interval", type=float, default=10)
+    sim = sub.add_parser("simulate", help="compare scheduling policies")
+    sim.add_argument("--trace", help="a trace written by `record`")
+    sim.add_argument("--synthetic-days", type=int, default=28)
+    sim.add_argument("--policy", action="append", required=True)
+    sim.add_argument("--no-backup-warning-seconds", type=int, default=86400)
+    sim.add_argument("--mean-backup-seconds", type=float, default=900)
+    sim.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.out, args.interval)
+        return
+
+    rng = random.Random(args.seed)
+    if args.trace:
+        start, trace = ActivityTrace.load(args.trace, gap_seconds=60)
+    else:
+        start, trace = datetime.datetime(2024, 1, 1), ActivityTrace.synthetic(args.synthetic_days, rng)
+
+    print(f"{'policy':>20} {'completed':>9} {'cancelled':>9} {'past warn h':>11} {'overlap h':>9} {'backup h':>8} {'sim/real':>10}")
+    for policy in args.policy:
+        # the same backup durations for every policy
+        durations = random.Random(args.seed)
+        wall = time.perf_counter()
+        r = simulate(policy, parse_policy(policy), trace, start,
+                     lambda: durations.expovariate(1 / args.mean_backup_seconds),
+                     args.no_backup_warning_seconds)
+        speedup = trace.length_seconds / max(time.perf_counter() - wall, 1e-9)
+        print(f"{policy:>20} {r.completed:>9} {r.cancelled:>9} {r.seconds_past_warning / 3600:>11.1f} "
+              f"{r.overlap_seconds / 3600:>9.1f} {r.backup_seconds / 3600:>8.1f} {speedup:>9.0f}x")
+
+
+if __name__ == "__main__":
+    run()
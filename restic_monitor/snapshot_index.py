@@ -0,0 +1,336 @@
+"""
+A local index of the files in the snapshots, to find what to restore without
+re-reading the trees of a remote repository on every query.
+
+Search the index and restore from the command line:
+
+    py -m restic_monitor.snapshot_index search report.docx
+    py -m restic_monitor.snapshot_index restore 8c2e8d68 /C/Users/me/Documents/report.docx --target C:\\restore
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import subprocess
+import time
+
+from .background import BackgroundWorker, WorkCancelled
+
+# Directories are stored once and paths once across all snapshots. The snapshots of the same
+# host and paths form a lineage, numbered by `lineage_seq`. A file that is unchanged over
+# consecutive snapshots of a lineage is a single row of `versions`, covering the snapshots of
+# that lineage whose `lineage_seq` is between `first` and `last`.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS lineages (
+    id INTEGER PRIMARY KEY,
+    hostname TEXT,
+    paths TEXT NOT NULL,
+    last_seq INTEGER NOT NULL,
+    UNIQUE (hostname, paths)
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    time TEXT NOT NULL,
+    hostname TEXT,
+    paths TEXT,
+    lineage_id INTEGER NOT NULL,
+    lineage_seq INTEGER NOT NULL,
+    files INTEGER
+);
+CREATE INDEX IF NOT EXISTS snapshots_lineage ON snapshots(lineage_id, lineage_seq);
+CREATE TABLE IF NOT EXISTS dirs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS paths (
+    id INTEGER PRIMARY KEY,
+    dir_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    UNIQUE (dir_id, name)
+);
+CREATE TABLE IF NOT EXISTS versions (
+    path_id INTEGER NOT NULL,
+    lineage_id INTEGER NOT NULL,
+    first INTEGER NOT NULL,
+    last INTEGER NOT NULL,
+    type INTEGER NOT NULL,
+    size INTEGER,
+    mtime INTEGER
+);
+CREATE INDEX IF NOT EXISTS versions_last ON versions(lineage_id, last, path_id);
+CREATE INDEX IF NOT EXISTS versions_path ON versions(path_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS path_fts USING fts5(path, content='', tokenize='trigram');
+"""
+
+STAGING_SCHEMA = """
+CREATE TEMP TABLE IF NOT EXISTS staging (
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    type INTEGER NOT NULL,
+    size INTEGER,
+    mtime INTEGER
+);
+"""
+
+NODE_TYPES = {"file": 0, "dir": 1, "symlink": 2}
+TYPE_NAMES = {v: k for k, v in NODE_TYPES.items()}
+
+BATCH_SIZE = 10000
+
+
+class IndexingCancelled(WorkCancelled):
+    pass
+
+
+def _mtime(value):
+    try:
+        return int(datetime.datetime.fromisoformat(value).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+
+class SnapshotIndex:
+    def __init__(self, db_filename):
+        self.db = sqlite3.connect(db_filename)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.db.executescript(STAGING_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def indexed_snapshot_ids(self):
+        return set(r[0] for r in self.db.execute("SELECT id FROM snapshots"))
+
+    def forget_snapshots(self, ids):
+        """
+        Drops snapshots that are gone from the repository. Their files stay in
+        the path tables, but no longer show up in search results.
+        """
+        with self.db:
+            self.db.executemany("DELETE FROM snapshots WHERE id = ?", [(i,) for i in ids])
+
+    def add_snapshot(self, snapshot: dict, nodes, cancelled=lambda: False):
+        """
+        Adds a snapshot from `restic snapshots --json` with its nodes from `restic ls --json`.
+        Either the whole snapshot is added or nothing, e.g. when `cancelled()` turns True.
+        """
+        with self.db:
+            self.db.execute("DELETE FROM staging")
+            batch = []
+            for node in nodes:
+                path = node.get("path")
+                if not path or node.get("type") not in NODE_TYPES:
+                    continue
+                parent, _, name = path.rpartition("/")
+                batch.append((parent, name, NODE_TYPES[node["type"]], node.get("size"), _mtime(node.get("mtime"))))
+                if len(batch) >= BATCH_SIZE:
+                    if cancelled():
+                        raise IndexingCancelled()
+                    self.db.executemany("INSERT INTO staging VALUES (?, ?, ?, ?, ?)", batch)
+                    batch = []
+            self.db.executemany("INSERT INTO staging VALUES (?, ?, ?, ?, ?)", batch)
+            if cancelled():
+                raise IndexingCancelled()
+
+            last_path_id = self.db.execute("SELECT COALESCE(MAX(id), 0) FROM paths").fetchone()[0]
+            self.db.execute("INSERT OR IGNORE INTO dirs (path) SELECT DISTINCT dir FROM staging")
+            self.db.execute("INSERT OR IGNORE INTO paths (dir_id, name) "
+                            "SELECT d.id, s.name FROM staging s JOIN dirs d ON d.path = s.dir")
+            self.db.execute("INSERT INTO path_fts (rowid, path) "
+                            "SELECT p.id, d.path || '/' || p.name FROM paths p JOIN dirs d ON d.id = p.dir_id "
+                            "WHERE p.id > ?", (last_path_id,))
+
+            # e.g. the stdin backups or other hosts are interleaved with the main backups
+            hostname = snapshot.get("hostname")
+            paths = json.dumps(sorted(snapshot.get("paths", [])))
+            self.db.execute("INSERT OR IGNORE INTO lineages (hostname, paths, last_seq) VALUES (?, ?, 0)",
+                            (hostname, paths))
+            # the sequence is never reused, even after the previous snapshot is forgotten
+            self.db.execute("UPDATE lineages SET last_seq = last_seq + 1 WHERE hostname IS ? AND paths = ?",
+                            (hostname, paths))
+            lineage, seq = self.db.execute("SELECT id, last_seq FROM lineages WHERE hostname IS ? AND paths = ?",
+                                           (hostname, paths)).fetchone()
+            self.db.execute("INSERT INTO snapshots (id, time, hostname, paths, lineage_id, lineage_seq) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (snapshot["id"], snapshot["time"], hostname, json.dumps(snapshot.get("paths", [])),
+                             lineage, seq))
+            prev = seq - 1
+            self.db.execute("CREATE TEMP TABLE current AS "
+                            "SELECT p.id AS path_id, s.type, s.size, s.mtime FROM staging s "
+                            "JOIN dirs d ON d.path = s.dir JOIN paths p ON p.dir_id = d.id AND p.name = s.name")
+            self.db.execute("CREATE INDEX temp.current_path ON current(path_id)")
+            # extend the versions that are unchanged since the previous snapshot
+            self.db.execute("UPDATE versions SET last = :seq WHERE lineage_id = :lineage AND last = :prev AND EXISTS ("
+                            "SELECT 1 FROM current c WHERE c.path_id = versions.path_id AND c.type = versions.type "
+                            "AND c.size IS versions.size AND c.mtime IS versions.mtime)",
+                            dict(lineage=lineage, seq=seq, prev=prev))
+            self.db.execute("INSERT INTO versions (path_id, lineage_id, first, last, type, size, mtime) "
+                            "SELECT c.path_id, :lineage, :seq, :seq, c.type, c.size, c.mtime FROM current c "
+                            "WHERE NOT EXISTS (SELECT 1 FROM versions v "
+                            "WHERE v.lineage_id = :lineage AND v.last = :seq AND v.path_id = c.path_id)",
+                            dict(lineage=lineage, seq=seq))
+            files = self.db.execute("SELECT COUNT(*) FROM current").fetchone()[0]
+            self.db.execute("DROP TABLE temp.current")
+            self.db.execute("DELETE FROM staging")
+            self.db.execute("UPDATE snapshots SET files = ? WHERE id = ?", (files, snapshot["id"]))
+
+    def search(self, pattern, limit=100):
+        """
+        Finds up to `limit` paths containing `pattern` (case-insensitive), with every snapshot they are in.
+        Returns up to `limit` dicts of path, snapshot id, snapshot time, type, size and mtime, newest snapshot first.
+        """
+        if len(pattern) >= 3:
+            path_ids = "SELECT rowid AS path_id FROM path_fts WHERE path_fts MATCH :match"
+        else:
+            # too short for the trigram index
+            path_ids = "SELECT p.id AS path_id FROM paths p JOIN dirs d ON d.id = p.dir_id WHERE d.path || '/' || p.name LIKE :like"
+        rows = self.db.execute(
+            "SELECT d.path || '/' || p.name, s.id, s.time, v.type, v.size, v.mtime "
+            f"FROM ({path_ids} LIMIT :limit) m "
+            "JOIN paths p ON p.id = m.path_id JOIN dirs d ON d.id = p.dir_id "
+            "JOIN versions v ON v.path_id = p.id "
+            "JOIN snapshots s ON s.lineage_id = v.lineage_id AND s.lineage_seq BETWEEN v.first AND v.last "
+            "ORDER BY s.time DESC, 1 LIMIT :limit",
+            dict(match='"' + pattern.replace('"', '""') + '"', like=f"%{pattern}%", limit=limit)).fetchall()
+        return [dict(path=r[0], snapshot=r[1], time=r[2], type=TYPE_NAMES[r[3]], size=r[4],
+                     mtime=None if r[5] is None else datetime.datetime.fromtimestamp(r[5]).isoformat())
+                for r in rows]
+
+
+class SnapshotIndexer(BackgroundWorker):
+    """
+    Keeps a SnapshotIndex up to date in the background. Only the snapshots that are not
+    in the index yet are listed, and only while `should_run()` says so, e.g. while the user
+    is idle. An interrupted snapshot is indexed again from scratch.
+
+    Checks for new snapshots right after each backup (see on_run_finished) and every `check_seconds`.
+    """
+    Cancelled = IndexingCancelled
+
+    def __init__(self, db_filename, restic_exe, env, host=None, check_seconds=3600, poll_seconds=10):
+        super().__init__(restic_exe, env, check_seconds=check_seconds, poll_seconds=poll_seconds)
+        self.db_filename = db_filename
+        self.host = host
+
+    def _list_snapshots(self):
+        args = ["snapshots", "--json"]
+        if self.host:
+            args += ["--host", self.host]
+        proc = self._start(args, stderr=subprocess.DEVNULL)
+        out = proc.stdout.read()
+        proc.wait()
+        self._done(proc)
+        if proc.returncode != 0:
+            raise Exception(f"restic snapshots failed with code {proc.returncode}")
+        return json.loads(out or "[]")
+
+    def _ls(self, snapshot_id):
+        proc = self._start(["ls", "--json", snapshot_id], stderr=subprocess.DEVNULL)
+        for line in proc.stdout:
+            node = json.loads(line)
+            # the first line describes the snapshot itself
+            if node.get("struct_type", "node") == "node":
+                yield node
+        proc.wait()
+        self._done(proc)
+        if proc.returncode != 0:
+            raise Exception(f"restic ls {snapshot_id} failed with code {proc.returncode}")
+
+    def work(self):
+        return self.update()
+
+    def update(self):
+        """
+        Blocking. Indexes the new snapshots, oldest first so that unchanged files extend
+        the versions of the previous snapshot of the same lineage. Returns the number of snapshots added.
+        """
+        self._begin()
+        index = SnapshotIndex(self.db_filename)
+        try:
+            snapshots = self._list_snapshots()
+            ids = set(s["id"] for s in snapshots)
+            indexed = index.indexed_snapshot_ids()
+            index.forget_snapshots(indexed - ids)
+            added = 0
+            for s in sorted(snapshots, key=lambda s: s["time"]):
+                if s["id"] in indexed:
+                    continue
+                started = time.monotonic()
+                index.add_snapshot(s, self._ls(s["id"]), lambda: self.cancel_requested)
+                self.logger.info(f"Indexed snapshot {s['id'][:8]} in {time.monotonic() - started:.1f}s")
+                added += 1
+            return added
+        finally:
+            index.close()
+
+    def on_finished(self, added):
+        self.logger.debug(f"SnapshotIndexer added {added} snapshots")
+        super().on_finished(added)
+
+    def on_run_finished(self, record: dict):
+        " run listener for ResticMonitor, a new snapshot may be there "
+        if record.get("code") in (0, 3):
+            self.wake_up()
+
+    def restore(self, snapshot_id, path, target):
+        " blocking, restores a single path of a snapshot into `target` "
+        return subprocess.call([self.restic_exe, "restore", snapshot_id, "--target", target, "--include", path],
+                               env=self._environ())
+
+
+def _format_size(size):
+    if size is None:
+        return ""
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def run():
+    from .appdir import get_appdir
+    from .main import APP_NAME, SETTINGS_FILENAME, ENV_FILENAME, RESTIC_EXE_SETTING, SNAPSHOT_INDEX_FILENAME
+
+    parser = argparse.ArgumentParser(description="search and restore files from the local snapshot index")
+    sub = parser.add_subparsers(dest="command", required=True)
+    search = sub.add_parser("search", help="find the snapshots containing a path")
+    search.add_argument("pattern")
+    search.add_argument("--limit", type=int, default=100)
+    sub.add_parser("update", help="index the new snapshots now")
+    restore = sub.add_parser("restore", help="restore a path from a snapshot")
+    restore.add_argument("snapshot")
+    restore.add_argument("path")
+    restore.add_argument("--target", required=True)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] (%(name)s): %(message)s")
+    appdir = get_appdir(APP_NAME)
+    db_filename = os.path.join(appdir, SNAPSHOT_INDEX_FILENAME)
+    if args.command == "search":
+        index = SnapshotIndex(db_filename)
+        started = time.perf_counter()
+        results = index.search(args.pattern, args.limit)
+        elapsed = time.perf_counter() - started
+        for r in results:
+            print(f"{r['snapshot'][:8]}  {r['time'][:19]}  {_format_size(r['size']):>10}  {r['mtime'] or '':19}  {r['path']}")
+        print(f"{len(results)} results in {elapsed * 1000:.1f} ms")
+        return
+
+    with open(os.path.join(appdir, SETTINGS_FILENAME)) as f:
+        settings = json.loads(f.read())
+    with open(os.path.join(appdir, ENV_FILENAME)) as f:
+        env = json.loads(f.read())
+    indexer = SnapshotIndexer(db_filename, settings[RESTIC_EXE_SETTING], env)
+    if args.command == "update":
+        print(f"Indexed {indexer.update()} new snapshots")
+    else:
+        return indexer.restore(args.snapshot, args.path, args.target)
+
+
+if __name__ == "__main__":
+    run()
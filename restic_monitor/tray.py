@@ -10,6 +10,11 @@ from .idle import get_idle_time
 import os
 from .pystray_patch import patch_on_notify
 from .openshell import openshell
+from .reporter import FleetReporter
+from .scheduler import BackupScheduler, SystemClock
+from .snapshot_index import SnapshotIndexer
+from .verifier import RestoreVerifier
+from .replication import Replicator
 
 class ResticTray:
     MAIN_ICON = "main.ico"
@@ -26,7 +31,14 @@ class ResticTray:
                  no_backup_warning_seconds: int,
                  pause_until_filename: str,
                  ignore_exit_code_3: bool,
-                 app_log:str) -> None:
+                 app_log:str,
+                 reporter: FleetReporter = None,
+                 cancel_on_activity: bool = False,
+                 clock = None,
+                 idle_source = get_idle_time,
+                 indexer: SnapshotIndexer = None,
+                 verifier: RestoreVerifier = None,
+                 replicator: Replicator = None) -> None:
         self.logger = logging.getLogger("ResticTray")
         self.logger.setLevel(logging.DEBUG)
         # extracted during run_async()
@@ -36,6 +48,9 @@ class ResticTray:
         self.update_menu_queued = False
         self.app_log = app_log
         self.min_seconds_between_backups = min_seconds_between_backups
+        self.scheduler = BackupScheduler(min_idle_seconds, min_seconds_between_backups, cancel_on_activity)
+        self.clock = clock or SystemClock()
+        self.idle_source = idle_source
         self.ignore_exit_code_3 = ignore_exit_code_3
         self.last_old_backup_warn_time:datetime.datetime = None
         m = menu(
@@ -43,6 +58,12 @@ class ResticTray:
                  action=lambda: None),
             item(lambda _: self.tray_get_info_line2_text(),
                  action=lambda: None),
+            item(lambda _: self.tray_get_verified_line_text(),
+                 action=lambda: None,
+                 visible=lambda _: self.verifier is not None),
+            item(lambda _: self.tray_get_replication_line_text(),
+                 action=lambda: None,
+                 visible=lambda _: self.replicator is not None),
             menu.SEPARATOR,
             item(
                 '▶️ Run now',
@@ -95,9 +116,19 @@ class ResticTray:
             icon=self.icon_images[ResticTray.MAIN_ICON])
         patch_on_notify(self.icon)
         self.monitor : ResticMonitor = monitor
+        self.reporter = reporter
+        self.indexer = indexer
+        self.verifier = verifier
+        self.replicator = replicator
+        if self.reporter:
+            self.monitor.run_listeners.append(self.reporter.on_run_finished)
+        if self.indexer:
+            self.monitor.run_listeners.append(self.indexer.on_run_finished)
         
         self.min_idle_seconds = min_idle_seconds
         self.run_requested = False
+        # whether the backup in progress was requested by the user
+        self.current_run_requested = False
         self.pause_until_filename = pause_until_filename
         self.pause_until: datetime.datetime = self._load_pause_until_from_file()
 
@@ -215,8 +246,8 @@ class ResticTray:
         with self.lock:
             if self.monitor.is_restic_running():
                 self.icon.icon = self.icon_images[ResticTray.RUNNING_ICON]
-                last_line = self.monitor.get_restic_last_lines(1)[0:64]
-                self.icon.title = f"In progress: {last_line}"
+                progress = self.monitor.get_progress_text() or self.monitor.get_restic_last_lines(1)[0:64]
+                self.icon.title = f"In progress: {progress}"
             elif self.is_paused():
                 self.icon.icon = self.icon_images[ResticTray.PAUSED_ICON]
                 pause_until_formatted = self.pause_until.strftime("%Y-%m-%d %I:%m %p")
@@ -276,7 +307,7 @@ class ResticTray:
             if not self.monitor.is_restic_running():
                 return f"Wait for idle for {idle_period_str}"
             else:
-                short_summary = self.monitor.get_restic_last_lines(1)[:32]
+                short_summary = self.monitor.get_progress_text() or self.monitor.get_restic_last_lines(1)[:32]
                 return f"Running: {short_summary}"
     
     def tray_get_info_line2_text(self):
@@ -285,6 +316,43 @@ class ResticTray:
         with self.lock:
             return self.get_last_ran_text()
 
+    def tray_get_verified_line_text(self):
+        """ The line about the last restore verification in the context menu
+        """
+        last = self.verifier.history.last_verification()
+        if last is None or last.get("no_snapshot"):
+            return "Restores not verified yet"
+        td = self.clock.now() - datetime.datetime.fromisoformat(last["finished"])
+        ago = self._format_timedelta_days(td)
+        if "error" in last:
+            return f"❌ Restore verification failed {ago} ago"
+        if last["failed"]:
+            return f"❌ {last['failed']} of {last['files']} files failed to restore {ago} ago"
+        speed = ""
+        if last.get("bytes_per_second"):
+            speed = f", {last['bytes_per_second'] / (1 << 20):.1f} MiB/s"
+        not_checked = ""
+        if last.get("not_checked"):
+            not_checked = f", {last['not_checked']} not checked in time"
+        restored = last["files"] - last.get("not_checked", 0)
+        return f"✅ Last verified {ago} ago: {restored} files restored{not_checked}{speed}"
+
+    def tray_get_replication_line_text(self):
+        """ The line about the replication targets in the context menu
+        """
+        lags = self.replicator.lag(self.clock.now())
+        for name, lag in lags.items():
+            if lag["last_error"]:
+                return f"❌ Replication to {name} failed"
+        behind = [(name, lag) for name, lag in lags.items() if lag["pending"]]
+        if behind:
+            name, lag = max(behind, key=lambda b: b[1]["lag_seconds"] or 0)
+            td = datetime.timedelta(seconds=lag["lag_seconds"] or 0)
+            return f"⏳ {name} is {lag['pending']} snapshots behind ({self._format_timedelta_days(td)})"
+        if any(lag["pending"] is None for lag in lags.values()):
+            return "Not replicated yet"
+        return f"✅ Replicated to {', '.join(lags)}"
+
     def get_last_ran_text(self):
         """
         Produces a user-friendly message about how long it's been since the last successful backup.
@@ -347,7 +415,7 @@ class ResticTray:
                     self.logger.info("Enabling pause")
                     if self.monitor.is_restic_running():
                         self.monitor.cancel_run()
-                    self._save_pause_until(datetime.datetime.now() + datetime.timedelta(hours=8))
+                    self._save_pause_until(self.clock.now() + datetime.timedelta(hours=8))
                     self.wakeup_watcher_event.clear()
                 else:
                     self.logger.info("Clearing pause")
@@ -369,19 +437,48 @@ class ResticTray:
                 return not paused
 
     def is_paused(self):
-        if self.pause_until is None:
-            logging.debug("currently not paused because pause_until is None")
-            return False
-        else:
-            logging.debug(f"now <= pause until {datetime.datetime.now() <= self.pause_until}")
-            return datetime.datetime.now() <= self.pause_until
+        return self.scheduler.is_paused(self.clock.now(), self.pause_until)
 
     def tray_is_paused(self):
         " from the external tray thread only "
         with self.lock:
             return self.is_paused()
+
+    def can_run_background_work(self):
+        """
+        Whether the user is away. Background work keeps running during backups: it would otherwise
+        only get the time between two backups, and `restic ls`/`restore` only take a shared lock.
+        """
+        with self.lock:
+            return not self.is_paused() and self.idle_source() > self.min_idle_seconds
+
+    def can_run_replication(self):
+        " whether no backup is running or about to, the user may be around "
+        with self.lock:
+            return not self.monitor.is_restic_running() and \
+                not self.run_requested and \
+                not self.is_paused()
+
+    def get_status(self):
+        " the state of the app, as reported to the fleet collector "
+        with self.lock:
+            status = self.monitor.get_status()
+            status["paused"] = self.is_paused()
+            if self.verifier:
+                status["last_verification"] = self.verifier.history.last_verification()
+            if self.replicator:
+                status["replication"] = self.replicator.lag(self.clock.now())
+            return status
             
     
+    async def run_scheduled_backup_async(self, requested):
+        " BackupScheduler.step calls this when it's time to run "
+        with self.lock:
+            self.current_run_requested = requested
+            self.run_requested = False
+        self.logger.debug("Running the job!!")
+        await self.run_backup_async()
+
     async def run_backup_async(self):
         """
         Wrapper around actually triggering a new backup job.
@@ -394,7 +491,16 @@ class ResticTray:
         def onprogress():
             self.sync_tray()
             self.logger.debug(f"onprogress callback")
-        retcode, cancelled = await self.monitor.run_backup(onprogress)
+        def cancel():
+            self.logger.info("The user is back, stopping the backup")
+            self.monitor.cancel_run()
+        backup = asyncio.create_task(self.monitor.run_backup(onprogress))
+        watcher = asyncio.create_task(self.scheduler.watch_backup(
+            self.clock, self.idle_source, self.current_run_requested, lambda: not backup.done(), cancel))
+        try:
+            retcode, cancelled = await backup
+        finally:
+            watcher.cancel()
         self.icon.title = f"Return code is {retcode}"
         if cancelled:
             self.icon.notify(self.monitor.get_restic_last_lines(3), title=f"User cancelled backup. code {retcode}")
@@ -406,7 +512,7 @@ class ResticTray:
     def warn_once_an_hour(self):
         secs = self.monitor.seconds_since_last_successful_run()
         if secs is None  or secs > self.no_backup_warning_seconds:
-            if self.last_old_backup_warn_time is not None and (datetime.datetime.now() - self.last_old_backup_warn_time) < datetime.timedelta(hours=1):
+            if self.last_old_backup_warn_time is not None and (self.clock.now() - self.last_old_backup_warn_time) < datetime.timedelta(hours=1):
                 self.logger.debug(f"Skipping old backup warning. Last warning:{self.last_old_backup_warn_time}")
                 return
             self.logger.debug("Showing old backup warning")
@@ -414,7 +520,7 @@ class ResticTray:
                 if not self.quit:
                     self.icon.notify(f"⚠️ It's been a long time since the last backup. {self.get_last_ran_text()}", "ResticMonitor")
             self.loop.call_later(1, notify)
-            self.last_old_backup_warn_time = datetime.datetime.now()
+            self.last_old_backup_warn_time = self.clock.now()
 
     async def run_async(self):
         self.loop = asyncio.get_event_loop()
@@ -423,6 +529,14 @@ class ResticTray:
         self.icon.run_detached()
 
         asyncio.create_task(self.main_tray_loop())
+        if self.reporter:
+            self.tasks.add(asyncio.create_task(self.reporter.run(self.get_status, lambda: self.quit)))
+        if self.indexer:
+            self.tasks.add(asyncio.create_task(self.indexer.run(self.can_run_background_work, lambda: self.quit)))
+        if self.verifier:
+            self.tasks.add(asyncio.create_task(self.verifier.run(self.can_run_background_work, lambda: self.quit)))
+        if self.replicator:
+            self.tasks.add(asyncio.create_task(self.replicator.run(self.can_run_replication, lambda: self.quit)))
 
         await asyncio.wait([
             asyncio.create_task(self.shutdown_event.wait()), 
@@ -435,27 +549,13 @@ class ResticTray:
         while not self.quit:
             # this loop is very important, and should continue to run.
             try:
-                waiter = None
-                idle_time = get_idle_time()
-                if self.tray_is_paused():
-                    # wait until the un-pause time for 1 hour (just in case), whichever is less 
-                    wait_time = min((self.pause_until - datetime.datetime.now()).total_seconds(), 3600)
-                    self.logger.debug(f"it's paused, nothing to do for {wait_time} seconds")
-                    waiter = asyncio.sleep(wait_time)
-                elif idle_time > self.min_idle_seconds or self.run_requested:
-                    self.run_requested = False
-                    if self.monitor.is_restic_running():
-                        self.logger.error("Already running... not possible check again in 10sec")
-                        waiter = asyncio.sleep(10)
-                    else:
-                        self.logger.debug("Running the job!!")
-                        await self.run_backup_async()
-                        waiter = asyncio.sleep(self.min_seconds_between_backups)
-                        self.logger.debug(f"after run, watcher will sleep for {self.min_seconds_between_backups}s")
-                else:
-                    remaining_idle = max(0, self.min_idle_seconds - idle_time)
-                    waiter = asyncio.sleep(remaining_idle)
-                    self.logger.debug(f"watcher will sleep for {remaining_idle}s for idle")
+                with self.lock:
+                    pause_until, run_requested = self.pause_until, self.run_requested
+                # runs the backup if it's time, otherwise it's paused or waiting for the user to be idle long enough
+                wait_time = await self.scheduler.step(self.clock, self.idle_source, pause_until, run_requested,
+                                                      self.monitor.is_restic_running, self.run_scheduled_backup_async)
+                waiter = self.clock.sleep(wait_time)
+                self.logger.debug(f"watcher will sleep for {wait_time}s")
                 
                 # wait until the waiting time, or until a wake up event.
                 await asyncio.wait([
@@ -0,0 +1,271 @@
+import datetime
+import hashlib
+import json
+import os
+import random
+import re
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .background import BackgroundWorker, WorkCancelled
+from .history import RunHistory
+
+# restic --include takes patterns, these paths couldn't be restored on their own
+PATTERN_CHARS = re.compile(r"[*?\[\]]")
+# restic lists C:\Users as /C/Users
+WINDOWS_DRIVE = re.compile(r"^/([A-Za-z])(/|$)")
+
+
+class VerificationCancelled(WorkCancelled):
+    pass
+
+
+class DeadlinePassed(Exception):
+    pass
+
+
+def _hash_file(filename, deadline=None):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise DeadlinePassed()
+            chunk = f.read(1 << 20)
+            if not chunk:
+                return h.hexdigest()
+            h.update(chunk)
+
+
+def live_path(snapshot_path):
+    " where a file of the snapshot is on this machine "
+    if os.name == "nt":
+        m = WINDOWS_DRIVE.match(snapshot_path)
+        if m:
+            return m.group(1) + ":\\" + snapshot_path[m.end():].replace("/", "\\")
+    return snapshot_path
+
+
+def restored_path(target, snapshot_path):
+    " where `restic restore --target` puts a file of the snapshot "
+    return os.path.join(target, *[p for p in snapshot_path.split("/") if p])
+
+
+class RestoreVerifier(BackgroundWorker):
+    """
+    Checks that files can actually be restored from the latest snapshot.
+
+    A random sample of the files of the snapshot, bounded by `max_files` and `max_bytes`, is
+    restored with `restic restore --include` into a temporary directory by `workers` restic
+    processes in parallel. Every restored file must have the size recorded in the snapshot,
+    and the same content as the live file when the live file hasn't changed since (same size
+    and modification time). The whole check is stopped after `max_seconds`: restic is killed,
+    and the files whose content wasn't compared yet are counted as `not_checked`.
+
+    The results are recorded in the RunHistory, and a check runs every `interval_seconds`
+    (`retry_seconds` after restic itself failed or when there was no snapshot yet), only while
+    `should_run()` says so. An interrupted check starts over as soon as it can.
+    """
+    Cancelled = VerificationCancelled
+
+    def __init__(self, restic_exe, env, history: RunHistory, host=None, interval_seconds=7 * 86400,
+                 max_files=20, max_bytes=512 << 20, max_seconds=900, workers=4, poll_seconds=10,
+                 retry_seconds=3600):
+        super().__init__(restic_exe, env, poll_seconds=poll_seconds)
+        self.history = history
+        self.host = host
+        self.interval_seconds = interval_seconds
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.workers = workers
+        self.retry_seconds = retry_seconds
+
+    def _latest_snapshot(self, deadline):
+        args = ["snapshots", "--json", "--latest", "1"]
+        if self.host:
+            args += ["--host", self.host]
+        try:
+            code, out = self._restic(args, timeout=max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            raise Exception("restic snapshots timed out")
+        if code != 0:
+            raise Exception(f"restic snapshots failed with code {code}: {out[-500:]}")
+        snapshots = [s for s in json.loads(out or "[]") if "id" in s]
+        return max(snapshots, key=lambda s: s["time"]) if snapshots else None
+
+    def _sample(self, snapshot_id, rng: random.Random, deadline):
+        """
+        Picks up to `max_files` files, `max_bytes` in total, in a single pass over `restic ls`.
+        A reservoir of a few times more candidates than needed leaves room to skip large files.
+        """
+        reservoir = []
+        reservoir_size = self.max_files * 4
+        seen = 0
+        proc = self._start(["ls", "--json", snapshot_id])
+        # restic can be silent for a long time, reading the lines can't check the deadline
+        timer = threading.Timer(max(deadline - time.monotonic(), 0), proc.kill)
+        timer.start()
+        try:
+            for line in proc.stdout:
+                if not line.startswith("{"):
+                    continue
+                node = json.loads(line)
+                if node.get("struct_type", "node") != "node" or node.get("type") != "file":
+                    continue
+                size = node.get("size", 0)
+                if size > self.max_bytes or PATTERN_CHARS.search(node["path"]):
+                    continue
+                seen += 1
+                if len(reservoir) < reservoir_size:
+                    reservoir.append(node)
+                else:
+                    i = rng.randrange(seen)
+                    if i < reservoir_size:
+                        reservoir[i] = node
+        except:
+            proc.kill()
+            raise
+        finally:
+            timer.cancel()
+            proc.wait()
+        self._done(proc)
+        if time.monotonic() >= deadline:
+            raise Exception(f"restic ls {snapshot_id} timed out")
+        if proc.returncode != 0:
+            raise Exception(f"restic ls {snapshot_id} failed with code {proc.returncode}")
+
+        rng.shuffle(reservoir)
+        sample = []
+        total = 0
+        for node in reservoir:
+            if len(sample) == self.max_files:
+                break
+            if total + node.get("size", 0) <= self.max_bytes:
+                sample.append(node)
+                total += node.get("size", 0)
+        return sample
+
+    def _restore(self, snapshot_id, nodes, target, deadline):
+        " restores a batch of files, returns None, the reason it failed, or DeadlinePassed "
+        args = ["restore", snapshot_id, "--target", target]
+        for node in nodes:
+            args += ["--include", node["path"]]
+        try:
+            code, out = self._restic(args, timeout=max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            return DeadlinePassed()
+        if code != 0:
+            lines = [l for l in out.splitlines() if l.strip()]
+            return f"restic restore failed with code {code}: {' '.join(lines[-2:])}"
+        return None
+
+    def _check(self, node, target, deadline):
+        """
+        Returns (whether the content was compared with the live file, failure reason or None),
+        raises DeadlinePassed when there was no time left to compare the content.
+        """
+        restored = restored_path(target, node["path"])
+        if not os.path.isfile(restored):
+            return False, "not restored"
+        if os.path.getsize(restored) != node.get("size", 0):
+            return False, f"restored {os.path.getsize(restored)} bytes instead of {node.get('size', 0)}"
+        live = live_path(node["path"])
+        try:
+            st = os.stat(live)
+            mtime = datetime.datetime.fromisoformat(node["mtime"]).timestamp()
+        except (OSError, KeyError, ValueError):
+            return False, None
+        # the live file changed since the snapshot, the size check will have to do
+        if st.st_size != node.get("size", 0) or abs(st.st_mtime - mtime) > 1:
+            return False, None
+        if _hash_file(restored, deadline) != _hash_file(live, deadline):
+            return True, "content differs from the unchanged live file"
+        return True, None
+
+    def verify(self, rng: random.Random = None):
+        """
+        Blocking. Returns the verification record, with `no_snapshot` when there's no snapshot yet.
+        """
+        self._begin()
+        rng = rng or random.Random()
+        started = datetime.datetime.now()
+        deadline = time.monotonic() + self.max_seconds
+        snapshot = self._latest_snapshot(deadline)
+        if snapshot is None:
+            now = datetime.datetime.now().isoformat()
+            return {"started": started.isoformat(), "finished": now, "files": 0, "failed": 0, "no_snapshot": True}
+        sample = self._sample(snapshot["id"], rng, deadline)
+        record = {
+            "started": started.isoformat(),
+            "snapshot": snapshot["id"],
+            "snapshot_time": snapshot["time"],
+            "files": len(sample),
+            "bytes": sum(n.get("size", 0) for n in sample),
+            "compared": 0,
+            "not_checked": 0,
+            "failed": 0,
+            "failures": [],
+        }
+
+        with tempfile.TemporaryDirectory(prefix="restic-monitor-verify-", ignore_cleanup_errors=True) as tmp:
+            batches = [sample[i::self.workers] for i in range(self.workers) if sample[i::self.workers]]
+            restore_started = time.monotonic()
+            with ThreadPoolExecutor(max_workers=max(len(batches), 1)) as executor:
+                # each batch goes to its own directory, so that the files of a failed batch don't count
+                targets = [os.path.join(tmp, str(i)) for i in range(len(batches))]
+                errors = list(executor.map(lambda b, t: self._restore(snapshot["id"], b, t, deadline), batches, targets))
+            restore_seconds = time.monotonic() - restore_started
+
+            restored_bytes = 0
+            for batch, target, error in zip(batches, targets, errors):
+                if isinstance(error, DeadlinePassed):
+                    # killed at the deadline, which says nothing about the backup
+                    record["not_checked"] += len(batch)
+                    continue
+                for node in batch:
+                    if error is None:
+                        try:
+                            compared, error_of_file = self._check(node, target, deadline)
+                        except DeadlinePassed:
+                            record["not_checked"] += 1
+                            compared, error_of_file = False, None
+                    else:
+                        compared, error_of_file = False, error
+                    record["compared"] += compared
+                    if error_of_file:
+                        record["failed"] += 1
+                        if len(record["failures"]) < 20:
+                            record["failures"].append({"path": node["path"], "reason": error_of_file})
+                    else:
+                        restored_bytes += node.get("size", 0)
+
+        record["finished"] = datetime.datetime.now().isoformat()
+        record["restore_seconds"] = restore_seconds
+        record["bytes_per_second"] = restored_bytes / restore_seconds if restore_seconds > 0 else None
+        return record
+
+    def work(self):
+        return self.verify()
+
+    def is_due(self):
+        last = self.history.last_verification()
+        if last is None:
+            return True
+        age = datetime.datetime.now() - datetime.datetime.fromisoformat(last["finished"])
+        retry = "error" in last or last.get("no_snapshot")
+        interval = min(self.interval_seconds, self.retry_seconds) if retry else self.interval_seconds
+        return age.total_seconds() > interval
+
+    def on_finished(self, record):
+        self.logger.info(f"Restore verification of {record.get('snapshot', '')[:8]}: "
+                         f"{record['files']} files, {record['failed']} failed, "
+                         f"{record.get('not_checked', 0)} not checked")
+        self.history.add_verification(record)
+
+    def on_failed(self, e: Exception):
+        self.logger.error("Restore verification failed", exc_info=e)
+        now = datetime.datetime.now().isoformat()
+        self.history.add_verification({"started": now, "finished": now, "files": 0, "failed": 1, "error": str(e)})
@@ -0,0 +1,24 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+# restic-monitor runs on Windows, this lets the tests spawn processes elsewhere too
+if not hasattr(subprocess, "CREATE_NO_WINDOW"):
+    subprocess.CREATE_NO_WINDOW = 0
+
+
+@pytest.fixture
+def fake_restic(tmp_path):
+    " writes a python script that stands in for restic (or a hook), returns its path "
+    if os.name == "nt":
+        pytest.skip("the fake restic is a script")
+
+    def make(source, name="restic"):
+        exe = tmp_path / name
+        exe.write_text(f"#!{sys.executable}\n" + textwrap.dedent(source))
+        exe.chmod(0o755)
+        return str(exe)
+    return make
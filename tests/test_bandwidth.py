@@ -0,0 +1,45 @@
+import datetime
+
+from restic_monitor.bandwidth import BandwidthPolicy, UNLIMITED_PROFILE
+
+POLICY = BandwidthPolicy.from_json([
+    {"name": "office", "days": ["mon", "tue", "wed", "thu", "fri"], "start": "08:00", "end": "18:00", "limit_upload": 1024},
+    {"name": "evening", "start": "18:00", "end": "23:00", "limit_upload": 768},
+    {"name": "night", "start": "23:00", "end": "06:00", "limit_upload": 100, "limit_download": 100},
+    {"name": "weekend", "days": ["sat", "sun"], "start": "08:00", "end": "18:00", "limit_upload": 0},
+])
+
+
+def profile(name):
+    return next(p for p in POLICY.profiles if p.name == name)
+
+
+def test_profile_at():
+    monday = datetime.datetime(2024, 1, 1)
+    assert POLICY.profile_at(monday.replace(hour=9)).name == "office"
+    assert POLICY.profile_at(monday.replace(hour=19)).name == "evening"
+    assert POLICY.profile_at(monday.replace(hour=23, minute=30)).name == "night"
+    assert POLICY.profile_at(monday.replace(hour=2)).name == "night"
+    assert POLICY.profile_at(monday.replace(hour=7)) is UNLIMITED_PROFILE
+    assert POLICY.profile_at(datetime.datetime(2024, 1, 6, 7)) is UNLIMITED_PROFILE
+
+
+def test_restic_args_replaces_the_limits():
+    args = ["backup", "--limit-upload", "50", "--limit-download=10", "C:\\"]
+    assert POLICY.restic_args(args, profile("night")) == \
+        ["backup", "C:\\", "--limit-upload=100", "--limit-download=100"]
+    assert POLICY.restic_args(args, UNLIMITED_PROFILE) == ["backup", "C:\\"]
+
+
+def test_should_restart_only_on_large_changes():
+    assert not POLICY.should_restart(profile("office"), profile("office"))
+    # 1024 -> 768 KiB/s is not worth a rescan
+    assert not POLICY.should_restart(profile("office"), profile("evening"))
+    assert POLICY.should_restart(profile("evening"), profile("night"))
+    assert POLICY.should_restart(profile("night"), UNLIMITED_PROFILE)
+    assert POLICY.should_restart(UNLIMITED_PROFILE, profile("office"))
+    # 0 is unlimited for restic
+    assert profile("weekend").limit_upload is None
+    assert profile("weekend").restic_args() == []
+    assert not POLICY.should_restart(profile("weekend"), UNLIMITED_PROFILE)
+    assert POLICY.should_restart(profile("weekend"), profile("office"))
@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+from restic_monitor.eta import EtaEstimator
+
+
+def status(elapsed, bytes_done, total_bytes=None, scanned=False, files_done=None, total_files=None):
+    message = {"message_type": "status", "seconds_elapsed": elapsed, "bytes_done": bytes_done}
+    if files_done is not None:
+        message["files_done"] = files_done
+        message["total_files"] = total_files
+    if total_bytes is not None:
+        message["total_bytes"] = total_bytes
+        message["percent_done"] = bytes_done / total_bytes
+    if scanned:
+        message["seconds_remaining"] = 0
+    return json.dumps(message, separators=(",", ":"))
+
+
+def test_scanning_with_history():
+    eta = EtaEstimator()
+    eta.begin({"bytes_per_second": 1000, "bytes_per_second_var": 0, "total_bytes": 100000, "scan_seconds": 50})
+    eta.on_line(status(10, 0, total_bytes=20000))
+    # the size of the last run and its throughput, the scan is not over yet
+    assert eta.estimate() == (0, 100, 100, 100)
+
+    eta.begin({"bytes_per_second": 1000, "bytes_per_second_var": 0, "total_bytes": 10000, "scan_seconds": 50})
+    eta.on_line(status(10, 0))
+    # at least what's left of the historical scan
+    assert eta.estimate() == (0, 40, 40, 40)
+
+
+def test_scanning_without_history():
+    eta = EtaEstimator()
+    eta.on_line(status(10, 0, total_bytes=20000))
+    eta.on_line(status(20, 10000, total_bytes=40000))
+    assert eta.rate == 1000
+    assert eta.estimate() is None
+    assert eta.progress_text() is None
+
+
+def test_after_the_scan():
+    eta = EtaEstimator()
+    eta.on_line(status(10, 0, total_bytes=50000, scanned=True))
+    assert eta.estimate() is None
+    eta.on_line(status(20, 10000, total_bytes=50000, scanned=True))
+    assert eta.scan_seconds == 10
+    assert eta.estimate() == (20, 40, 40, 40)
+
+    # faster: the estimate moves part of the way towards 15 seconds, the band widens
+    eta.on_line(status(30, 30000, total_bytes=50000, scanned=True))
+    percent, seconds, low, high = eta.estimate()
+    assert percent == 60
+    assert seconds == pytest.approx(27)
+    assert low == pytest.approx(20000 / (4000 / 3 + 1.64 * (1e6 / 3) ** 0.5))
+    assert high == pytest.approx(20000 / (4000 / 3 - 1.64 * (1e6 / 3) ** 0.5))
+    assert eta.progress_text() == "60%, 27s left (8s-51s)"
+
+
+def test_files_left_count_after_the_scan():
+    # many small files left: 990 files at 1 file/s, while the bytes would be done in 10s
+    eta = EtaEstimator(smoothing=1)
+    eta.on_line(status(10, 0, total_bytes=100000, scanned=True, files_done=0, total_files=1000))
+    eta.on_line(status(20, 50000, total_bytes=100000, scanned=True, files_done=10, total_files=1000))
+    assert eta.estimate() == (50, 990, 990, 990)
+
+    # a large file left: the bytes take longer than the files
+    eta.begin(None)
+    eta.on_line(status(10, 0, total_bytes=100000, scanned=True, files_done=0, total_files=1000))
+    eta.on_line(status(20, 10000, total_bytes=100000, scanned=True, files_done=500, total_files=1000))
+    assert eta.estimate() == (10, 90, 90, 90)
+
+
+def test_files_are_ignored_during_the_warmup_with_history():
+    eta = EtaEstimator(warmup_seconds=120, smoothing=1)
+    eta.begin({"bytes_per_second": 5000, "bytes_per_second_var": 0})
+    eta.on_line(status(10, 0, total_bytes=100000, scanned=True, files_done=0, total_files=1000))
+    eta.on_line(status(20, 50000, total_bytes=100000, scanned=True, files_done=10, total_files=1000))
+    assert eta.estimate()[1] == pytest.approx(10)
+
+
+def test_live_rate_takes_over_from_history_during_warmup():
+    eta = EtaEstimator(warmup_seconds=120, smoothing=1)
+    eta.begin({"bytes_per_second": 1000, "bytes_per_second_var": 0})
+    eta.on_line(status(50, 0, total_bytes=400000, scanned=True))
+    eta.on_line(status(60, 20000, total_bytes=400000, scanned=True))
+    # half way through the warmup, half the live 2000 B/s and half the historical 1000 B/s
+    assert eta.estimate()[1] == pytest.approx(380000 / 1500)
+
+
+def test_other_lines_are_ignored():
+    eta = EtaEstimator()
+    eta.on_line("open repository")
+    eta.on_line('{"message_type":"verbose_status","action":"new"}')
+    eta.on_line('{"message_type":"status",')
+    assert eta.elapsed is None
+    eta.on_line('{"message_type":"summary","total_bytes_processed":5}')
+    assert eta.run_stats()["bytes_done"] == 5
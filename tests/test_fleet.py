@@ -0,0 +1,141 @@
+import asyncio
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from restic_monitor.collector import FleetStore, make_server
+from restic_monitor.reporter import FleetReporter
+
+TOKEN = "secret"
+
+
+class Collector:
+    " a collector on localhost, on an ephemeral port unless given one "
+    def __init__(self, db_filename, port=0):
+        self.server = make_server("127.0.0.1", port, db_filename, token=TOKEN)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.port}{path}"
+
+    def get(self, path, token=TOKEN):
+        request = urllib.request.Request(self.url(path))
+        if token:
+            request.add_header("Authorization", f"Bearer {token}")
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return json.loads(response.read())
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+@pytest.fixture
+def collector(tmp_path):
+    c = Collector(str(tmp_path / "fleet.db"))
+    yield c
+    c.stop()
+
+
+def make_reporter(tmp_path, url, machine, token=TOKEN, **kwargs):
+    return FleetReporter(url=url, machine=machine, outbox_filename=str(tmp_path / f"{machine}-outbox.json"),
+                         token=token, timeout_seconds=5, **kwargs)
+
+
+def run_record(finished, code=0):
+    return {"started": finished - 60, "finished": finished, "duration_seconds": 60, "code": code, "cancelled": False}
+
+
+def test_stale_machines(tmp_path, collector):
+    now = time.time()
+    fresh = make_reporter(tmp_path, collector.url("/reports"), "fresh")
+    old = make_reporter(tmp_path, collector.url("/reports"), "old")
+    failing = make_reporter(tmp_path, collector.url("/reports"), "failing")
+    fresh.on_run_finished(run_record(now - 600))
+    old.on_run_finished(run_record(now - 3 * 86400))
+    old.on_run_finished(run_record(now - 600, code=1))
+    failing.on_run_finished(run_record(now - 600, code=3))
+    for reporter in [fresh, old, failing]:
+        assert asyncio.run(reporter.flush())
+        assert reporter.outbox == []
+
+    stale = collector.get("/machines/stale?seconds=86400")
+    assert [m["machine"] for m in stale] == ["failing", "old"]
+    assert stale[1]["last_run_code"] == 1
+    assert [m["machine"] for m in collector.get("/machines")] == ["failing", "fresh", "old"]
+
+
+def test_stale_machines_uses_the_index(tmp_path):
+    store = FleetStore(str(tmp_path / "fleet.db"))
+    statements = []
+    store.db.set_trace_callback(statements.append)
+    store.stale_machines(86400)
+    store.db.set_trace_callback(None)
+    plan = store.db.execute("EXPLAIN QUERY PLAN " + statements[-1]).fetchall()
+    details = [row[-1] for row in plan]
+    assert not any(d.startswith("SCAN") for d in details)
+    assert sum(d.startswith("SEARCH machines USING INDEX machines_last_success") for d in details) == 2
+
+
+def test_wrong_token_is_rejected(tmp_path, collector):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        collector.get("/machines", token=None)
+    assert e.value.code == 401
+
+    reporter = make_reporter(tmp_path, collector.url("/reports"), "intruder", token="wrong")
+    reporter.on_run_finished(run_record(time.time()))
+    assert not asyncio.run(reporter.flush())
+    assert len(reporter.outbox) == 1
+    assert collector.get("/machines") == []
+
+
+def test_outbox_survives_a_collector_outage(tmp_path):
+    db_filename = str(tmp_path / "fleet.db")
+    collector = Collector(db_filename)
+    port = collector.port
+    url = collector.url("/reports")
+    collector.stop()
+
+    reporter = make_reporter(tmp_path, url, "laptop")
+    reporter.on_run_finished(run_record(time.time() - 120))
+    reporter.on_run_finished(run_record(time.time() - 60))
+    assert not asyncio.run(reporter.flush())
+    assert len(reporter.outbox) == 2
+
+    # the app restarts, then the collector is back
+    restarted = make_reporter(tmp_path, url, "laptop")
+    assert len(restarted.outbox) == 2
+    collector = Collector(db_filename, port=port)
+    try:
+        assert asyncio.run(restarted.flush())
+        assert make_reporter(tmp_path, url, "laptop").outbox == []
+        [machine] = collector.get("/machines")
+        assert machine["machine"] == "laptop"
+        assert machine["last_success"] == pytest.approx(time.time() - 60, abs=5)
+    finally:
+        collector.stop()
+
+
+def test_run_sends_heartbeats(tmp_path, collector):
+    reporter = make_reporter(tmp_path, collector.url("/reports"), "desktop", heartbeat_seconds=1)
+    sent = []
+
+    def should_quit():
+        sent.extend(collector.get("/machines"))
+        return bool(sent)
+
+    async def run():
+        await asyncio.wait_for(reporter.run(lambda: {"running": True, "paused": False, "last_success": None},
+                                            should_quit), timeout=10)
+
+    asyncio.run(run())
+    [machine] = collector.get("/machines")
+    assert machine["running"] == 1
+    assert machine["last_success"] is None
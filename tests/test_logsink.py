@@ -0,0 +1,105 @@
+from restic_monitor.logsink import BoundedLogSink, FullLogSink
+
+
+def make_sink(tmp_path, **kwargs):
+    options = dict(head_lines=3, tail_lines=2, max_error_lines=2, checkpoint_seconds=3600)
+    options.update(kwargs)
+    return BoundedLogSink(str(tmp_path / "restic-last.log"), **options)
+
+
+def read_log(tmp_path):
+    return (tmp_path / "restic-last.log").read_text(encoding="utf-8").splitlines()
+
+
+def test_short_run_is_kept_whole(tmp_path):
+    sink = make_sink(tmp_path)
+    for i in range(4):
+        sink.write(f"line {i}")
+    sink.close()
+    assert read_log(tmp_path) == [
+        "line 0", "line 1", "line 2", "line 3",
+        "[restic-monitor: kept 4 of 4 lines, dropped 0 lines including 0 error/warning lines]",
+    ]
+
+
+def test_omitted_lines_are_marked(tmp_path):
+    sink = make_sink(tmp_path)
+    for i in range(10):
+        sink.write(f"line {i}")
+    sink.close()
+    assert read_log(tmp_path) == [
+        "line 0", "line 1", "line 2",
+        "[... 5 lines omitted ...]",
+        "line 8", "line 9",
+        "[restic-monitor: kept 5 of 10 lines, dropped 5 lines including 0 error/warning lines]",
+    ]
+
+
+def test_errors_are_kept_and_counted_when_dropped(tmp_path):
+    sink = make_sink(tmp_path)
+    for i in range(3):
+        sink.write(f"head {i}")
+    for i in range(5):
+        sink.write(f"error: cannot read file {i}")
+        sink.write(f"noise {i}")
+    for i in range(2):
+        sink.write(f"tail {i}")
+    sink.close()
+    log = read_log(tmp_path)
+    assert log == [
+        "head 0", "head 1", "head 2",
+        "error: cannot read file 0",
+        "[... 1 lines omitted ...]",
+        "error: cannot read file 1",
+        "[... 7 lines omitted ...]",
+        "tail 0", "tail 1",
+        "[restic-monitor: kept 7 of 15 lines, dropped 8 lines including 3 error/warning lines]",
+    ]
+
+
+def test_summary_is_kept_past_the_head_and_tail(tmp_path):
+    sink = make_sink(tmp_path)
+    for i in range(5):
+        sink.write(f"line {i}")
+    sink.write("Files:          10 new,     0 changed,     5 unmodified")
+    sink.write('{"message_type":"summary","files_new":10}')
+    for i in range(5):
+        sink.write(f"after {i}")
+    sink.close()
+    log = read_log(tmp_path)
+    assert "Files:          10 new,     0 changed,     5 unmodified" in log
+    assert '{"message_type":"summary","files_new":10}' in log
+    assert log.index("[... 2 lines omitted ...]") < log.index('{"message_type":"summary","files_new":10}')
+    assert log[-3:-1] == ["after 3", "after 4"]
+
+
+def test_memory_is_bounded_with_many_errors(tmp_path):
+    sink = make_sink(tmp_path, max_error_lines=10)
+    for i in range(10000):
+        sink.write(f"error: {i}")
+    assert len(sink.head) == 3
+    assert len(sink.tail) == 2
+    assert len(sink.errors) == 10
+    assert sink.dropped_errors == 10000 - 3 - 10
+    assert sink.last_lines(2) == "error: 9998\nerror: 9999"
+    sink.close()
+    assert read_log(tmp_path)[-1] == \
+        "[restic-monitor: kept 15 of 10000 lines, dropped 9985 lines including 9987 error/warning lines]"
+
+
+def test_checkpoint_rewrites_the_file(tmp_path):
+    sink = make_sink(tmp_path, checkpoint_seconds=0)
+    sink.write("line 0")
+    assert read_log(tmp_path)[0] == "line 0"
+    sink.write("line 1")
+    assert read_log(tmp_path)[:2] == ["line 0", "line 1"]
+    sink.close()
+
+
+def test_full_sink_keeps_every_line(tmp_path):
+    sink = FullLogSink(str(tmp_path / "restic-last.log"), recent_lines=2)
+    for i in range(5):
+        sink.write(f"line {i}")
+    assert sink.last_lines(3) == "line 3\nline 4"
+    sink.close()
+    assert read_log(tmp_path) == [f"line {i}" for i in range(5)]
@@ -0,0 +1,236 @@
+import asyncio
+import os
+import sys
+import time
+
+from restic_monitor.bandwidth import BandwidthPolicy, UNLIMITED_PROFILE
+from restic_monitor.hooks import HOOK_FAILED_CODE, HookCommand, HookPipeline, StdinBackup
+from restic_monitor.monitor import ResticMonitor
+from restic_monitor.profiler import ScanProfiler
+
+
+def make_monitor(tmp_path, restic_exe=None, **kwargs):
+    os.makedirs(tmp_path / "logs", exist_ok=True)
+    return ResticMonitor(app_dir=str(tmp_path), restic_exe=restic_exe or str(tmp_path / "no-such-restic.exe"),
+                         args=["backup", str(tmp_path)], env={}, **kwargs)
+
+
+def read_log(tmp_path):
+    return (tmp_path / "logs" / "restic-last.log").read_text().splitlines()
+
+
+def test_missing_restic_exe_fails_the_run(tmp_path):
+    exit_code_file = tmp_path / "exit-code.txt"
+    post = HookCommand([sys.executable, "-c",
+                        "import os, sys; open(sys.argv[1], 'w').write(os.environ['RESTIC_MONITOR_EXIT_CODE'])",
+                        str(exit_code_file)])
+    monitor = make_monitor(tmp_path, hooks=HookPipeline(post=[post]))
+    records = []
+    monitor.run_listeners.append(records.append)
+
+    for _ in range(2):
+        retval, cancelled = asyncio.run(monitor.run_backup(lambda: None))
+        assert (retval, cancelled) == (HOOK_FAILED_CODE, False)
+        assert not monitor.is_restic_running()
+        assert monitor.last_run_code() == HOOK_FAILED_CODE
+        assert monitor.restic_proc is None
+        assert not monitor.hook_procs
+        assert not monitor.cancel_requested
+        assert monitor.log_sink.file.closed
+        assert exit_code_file.read_text() == str(HOOK_FAILED_CODE)
+        exit_code_file.unlink()
+
+    assert [r["code"] for r in records] == [HOOK_FAILED_CODE, HOOK_FAILED_CODE]
+    assert "the backup failed" in records[0]["hook_failures"][0]
+    log = (tmp_path / "logs" / "restic-last.log").read_text()
+    assert "[restic-monitor: the backup failed: FileNotFoundError" in log
+    assert monitor.seconds_since_last_successful_run() is None
+
+
+def test_stdin_backups_keep_the_global_options(tmp_path):
+    monitor = make_monitor(tmp_path)
+    monitor.args = ["-r", "/some/repo", "--password-file=C:\\restic\\pw.txt", "backup", "--exclude", "*.tmp",
+                    "-o", "s3.storage-class=STANDARD_IA", "C:\\Users", "-vv", "--tag", "daily", "--limit-upload", "100"]
+    assert monitor._stdin_backup_command(None) == [
+        monitor.restic_exe, "-r", "/some/repo", "--password-file=C:\\restic\\pw.txt",
+        "-o", "s3.storage-class=STANDARD_IA", "-vv", "--limit-upload", "100", "backup"]
+
+
+def test_failing_output_listener_doesnt_stop_the_output(tmp_path, fake_restic):
+    exe = fake_restic("""
+        for i in range(3):
+            print(f"line {i}", flush=True)
+    """)
+    monitor = make_monitor(tmp_path, restic_exe=exe)
+    lines = []
+
+    def failing(line):
+        if line == "line 1":
+            raise ValueError(line)
+    monitor.output_listeners[:0] = [failing]
+    monitor.output_listeners.append(lines.append)
+
+    assert asyncio.run(monitor.run_backup(lambda: None)) == (0, False)
+    assert lines == ["line 0", "line 1", "line 2"]
+    assert read_log(tmp_path) == ["line 0", "line 1", "line 2"]
+
+
+# backs up stdin into a file next to the script once restic's stdin is closed, so a killed
+# restic saves nothing, and records the arguments of the main backup
+STDIN_RESTIC = """
+    import os, sys, time
+    out = os.path.dirname(sys.argv[0])
+    if "--stdin" in sys.argv:
+        name = next(a.split("=", 1)[1] for a in sys.argv if a.startswith("--stdin-filename="))
+        data = sys.stdin.buffer.read()
+        with open(os.path.join(out, name), "wb") as f:
+            f.write(data)
+        with open(os.path.join(out, name + ".args"), "w") as f:
+            f.write(" ".join(sys.argv[1:]))
+    else:
+        with open(os.path.join(out, "main-backup"), "w") as f:
+            f.write(" ".join(sys.argv[1:]))
+"""
+
+
+def python_command(source, *args):
+    return [sys.executable, "-c", source] + [str(a) for a in args]
+
+
+# writes its start and end times to a file, prints `data` `repeat` times in between
+PRODUCER = """
+import sys, time
+log, name, seconds, data, repeat, code = sys.argv[1:]
+with open(log, "a") as f:
+    f.write(f"start {name} {time.monotonic()}\\n")
+sys.stdout.write(data * int(repeat))
+sys.stdout.flush()
+time.sleep(float(seconds))
+with open(log, "a") as f:
+    f.write(f"end {name} {time.monotonic()}\\n")
+sys.exit(int(code))
+"""
+
+
+def producer(tmp_path, name, seconds=0, data="dump", repeat=1, code=0, **kwargs):
+    return StdinBackup(python_command(PRODUCER, tmp_path / "producers.log", name, seconds, data, repeat, code),
+                       f"{name}.sql", **kwargs)
+
+
+def run(monitor):
+    records = []
+    monitor.run_listeners.append(records.append)
+    retval, cancelled = asyncio.run(monitor.run_backup(lambda: None))
+    return retval, cancelled, records[0]
+
+
+def test_stdin_backup_pipes_the_producer_into_restic(tmp_path, fake_restic):
+    hooks = HookPipeline(stdin_backups=[producer(tmp_path, "db", data="x", repeat=3000000, args=["--tag", "db"])])
+    monitor = make_monitor(tmp_path, restic_exe=fake_restic(STDIN_RESTIC), hooks=hooks)
+    monitor.args = ["-r", "/repo", "backup", "--exclude", "*.tmp", str(tmp_path)]
+    retval, cancelled, record = run(monitor)
+    assert (retval, cancelled, record["hook_failures"]) == (0, False, [])
+    assert (tmp_path / "main-backup").read_text() == f"-r /repo backup --exclude *.tmp {tmp_path}"
+    assert (tmp_path / "db.sql").read_text() == "x" * 3000000
+    assert (tmp_path / "db.sql.args").read_text() == "-r /repo backup --stdin --stdin-filename=db.sql --tag db"
+
+
+def test_failed_producer_leaves_no_snapshot(tmp_path, fake_restic):
+    hooks = HookPipeline(stdin_backups=[producer(tmp_path, "db", data="truncated", code=2)])
+    monitor = make_monitor(tmp_path, restic_exe=fake_restic(STDIN_RESTIC), hooks=hooks)
+    retval, cancelled, record = run(monitor)
+    assert retval == HOOK_FAILED_CODE
+    assert record["hook_failures"] == ["db.sql failed with code 2"]
+    assert not (tmp_path / "db.sql").exists()
+    assert "[restic-monitor: db.sql failed with code 2]" in read_log(tmp_path)
+
+
+def test_producer_and_hook_timeouts(tmp_path, fake_restic):
+    hooks = HookPipeline(stdin_backups=[producer(tmp_path, "db", seconds=60, timeout_seconds=1)])
+    monitor = make_monitor(tmp_path, restic_exe=fake_restic(STDIN_RESTIC), hooks=hooks)
+    started = time.monotonic()
+    retval, _, record = run(monitor)
+    assert time.monotonic() - started < 30
+    assert retval == HOOK_FAILED_CODE
+    assert record["hook_failures"] == ["db.sql timed out after 1s"]
+    assert not (tmp_path / "db.sql").exists()
+
+    (tmp_path / "main-backup").unlink()
+    slow = HookCommand(python_command("import time; time.sleep(60)"), name="slow", timeout_seconds=1)
+    monitor = make_monitor(tmp_path, restic_exe=fake_restic(STDIN_RESTIC), hooks=HookPipeline(pre=[slow]))
+    started = time.monotonic()
+    retval, _, record = run(monitor)
+    assert time.monotonic() - started < 30
+    assert retval == HOOK_FAILED_CODE
+    assert record["hook_failures"] == ["hook slow timed out after 1s"]
+    # a failed pre-backup hook skips the backup
+    assert not (tmp_path / "main-backup").exists()
+
+
+def test_stdin_backups_are_limited(tmp_path, fake_restic):
+    backups = [producer(tmp_path, f"db{i}", seconds=1.5) for i in range(3)]
+    hooks = HookPipeline(stdin_backups=backups, max_concurrent_stdin_backups=2)
+    monitor = make_monitor(tmp_path, restic_exe=fake_restic(STDIN_RESTIC), hooks=hooks)
+    assert run(monitor)[0] == 0
+    running = 0
+    most = 0
+    events = [line.split() for line in (tmp_path / "producers.log").read_text().splitlines()]
+    for kind, _, _ in sorted(events, key=lambda e: float(e[2])):
+        running += 1 if kind == "start" else -1
+        most = max(most, running)
+    assert most == 2
+    assert all((tmp_path / f"db{i}.sql").read_text() == "dump" for i in range(3))
+
+
+def test_cancel_kills_the_hooks(tmp_path, fake_restic):
+    started_file = tmp_path / "started"
+    first = HookCommand(python_command("import sys, time; open(sys.argv[1], 'w').close(); time.sleep(60)",
+                                       started_file), name="first")
+    second = HookCommand(python_command("import sys; open(sys.argv[1], 'w').close()", tmp_path / "second"),
+                         name="second")
+    monitor = make_monitor(tmp_path, restic_exe=fake_restic(STDIN_RESTIC), hooks=HookPipeline(post=[first, second]))
+    records = []
+    monitor.run_listeners.append(records.append)
+
+    async def cancel_when_started():
+        while not started_file.exists():
+            await asyncio.sleep(0.1)
+        monitor.cancel_run()
+
+    async def scenario():
+        canceller = asyncio.create_task(cancel_when_started())
+        result = await monitor.run_backup(lambda: None)
+        await canceller
+        return result
+
+    started = time.monotonic()
+    retval, cancelled = asyncio.run(scenario())
+    assert time.monotonic() - started < 30
+    assert cancelled
+    # the killed hook failed the run, the one after it never started
+    assert retval == HOOK_FAILED_CODE
+    assert records[0]["hook_failures"][0].startswith("hook first failed with code")
+    assert len(records[0]["hook_failures"]) == 1
+    assert not (tmp_path / "second").exists()
+    assert not monitor.hook_procs
+
+
+def test_profiler_starts_over_when_restic_restarts(tmp_path, fake_restic):
+    exe = fake_restic("""
+        import time
+        print("unchanged /data/a.txt", flush=True)
+        print("unchanged /data/b.txt", flush=True)
+        time.sleep(1.5)
+    """)
+    policy = BandwidthPolicy.from_json([{"name": "slow", "start": "00:00", "end": "23:59", "limit_upload": 10}])
+    monitor = make_monitor(tmp_path, restic_exe=exe, bandwidth_policy=policy)
+    profiler = ScanProfiler(str(tmp_path / "scan-profile.txt"))
+    monitor.output_listeners.append(profiler.on_line)
+    monitor.start_listeners.append(profiler.reset)
+    switches = [UNLIMITED_PROFILE]
+    monitor._bandwidth_profile_switch = lambda current: switches.pop() if switches else None
+
+    retval, _, record = run(monitor)
+    assert (retval, record["restarts"]) == (0, 1)
+    # the rescan after the restart doesn't count the files twice
+    assert profiler.root.files == 2
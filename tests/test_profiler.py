@@ -0,0 +1,93 @@
+import json
+
+from restic_monitor import profiler
+from restic_monitor.profiler import ScanProfiler
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+def node_at(p, path):
+    node = p.root
+    for part in path.split("/"):
+        node = node.children[part]
+    return node
+
+
+def test_verbose_text_lines(tmp_path):
+    p = ScanProfiler(str(tmp_path / "scan-profile.txt"))
+    p.on_line("open repository")
+    p.on_line("new       /home/me/docs/a.txt, saved in 0.012s (1.500 KiB added)")
+    p.on_line("modified  /home/me/docs/b.txt, saved in 0.020s (2 MiB added, 1.100 MiB stored, 1.000 KiB metadata)")
+    p.on_line("unchanged /home/me/docs/c.txt")
+    p.on_line("modified  /home/me/docs/, saved in 0.001s (0 B added, 345 B stored, 1.234 KiB metadata)")
+    p.on_line("unchanged C:\\Users\\me\\d.txt")
+    p.on_line("Files:           1 new,     1 changed,     2 unmodified")
+
+    assert (p.root.files, p.root.new, p.root.changed) == (4, 1, 1)
+    docs = node_at(p, "home/me/docs")
+    assert (docs.files, docs.new, docs.changed) == (3, 1, 1)
+    assert docs.bytes == 1536 + 2 * (1 << 20)
+    # the directory line isn't a file, and doesn't create a node of its own
+    assert docs.children == {}
+    assert node_at(p, "C:/Users/me").files == 1
+
+
+def test_verbose_status_json_lines(tmp_path):
+    p = ScanProfiler(str(tmp_path / "scan-profile.txt"))
+    for action, item, size in [("new", "/srv/a.bin", 100), ("unchanged", "/srv/b.bin", 200),
+                               ("modified", "/srv/", 0), ("scan_finished", "", 0)]:
+        p.on_line(json.dumps({"message_type": "verbose_status", "action": action, "item": item,
+                              "duration": 0.1, "data_size": size}, separators=(",", ":")))
+    p.on_line('{"message_type":"status","percent_done":0.5}')
+    p.on_line('{"message_type":"verbose_status",')
+    srv = node_at(p, "srv")
+    assert (srv.files, srv.bytes, srv.new, srv.changed) == (2, 300, 1, 0)
+
+
+def test_tree_is_bounded(tmp_path):
+    p = ScanProfiler(str(tmp_path / "scan-profile.txt"), max_depth=2, max_nodes=3)
+    p.on_line("new       /a/b/c/d/deep.txt")
+    assert node_at(p, "a/b").children == {}
+    assert node_at(p, "a/b").files == 1
+    assert p.nodes == 3
+    # no room for another directory, the file counts towards the root
+    p.on_line("new       /x/other.txt")
+    assert "x" not in p.root.children
+    assert p.root.files == 2
+    assert p.nodes == 3
+
+
+def test_report_ranks_the_directories(tmp_path, monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(profiler, "time", clock)
+    p = ScanProfiler(str(tmp_path / "scan-profile.txt"), top=4)
+
+    def item(seconds, line):
+        clock.now += seconds
+        p.on_line(line)
+
+    item(0, "unchanged /data/cache/0.bin")
+    for i in range(1, 4):
+        item(10, f"unchanged /data/cache/{i}.bin")
+    for i in range(4):
+        item(20, f"new       /data/photos/{i}.jpg")
+    item(1, "unchanged /data/notes/0.txt")
+
+    report = p.report()
+    slowest = report.split("\n\n")[1].splitlines()[2:]
+    least_changing = report.split("\n\n")[2].splitlines()[2:]
+    # "data" accounts for every second of the root, it's listed, the root isn't
+    assert [line.split()[-1] for line in slowest] == ["data", "data/photos", "data/cache", "data/notes"]
+    # by the time spent on unchanged files: all of cache's, none of photos'
+    assert [line.split()[-1] for line in least_changing] == ["data", "data/cache", "data/notes", "data/photos"]
+    assert report.startswith("Scan profile: 9 files, 4 new, 0 changed, 111.0s in 5 directories tracked")
+
+    p.on_run_finished({"code": 0})
+    assert (tmp_path / "scan-profile.txt").read_text(encoding="utf-8") == report
+    assert p.report() is None
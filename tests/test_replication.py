@@ -0,0 +1,184 @@
+import datetime
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from restic_monitor.replication import ReplicationCancelled, ReplicationTarget, Replicator
+
+PASSWORD = "source password"
+TARGET_PASSWORD = "target password"
+
+
+class CountingReplicator(Replicator):
+    " records the restic commands, and cancels itself after `cancel_after` copies "
+    def __init__(self, *args, cancel_after=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commands = []
+        self.cancel_after = cancel_after
+
+    def _restic(self, args, environ=None, timeout=None):
+        self.commands.append(args)
+        result = super()._restic(args, environ, timeout)
+        if self.cancel_after is not None and len(self.copied_ids()) >= self.cancel_after:
+            self.cancel()
+        return result
+
+    def copied_ids(self):
+        return [i for args in self.commands if args[0] == "copy" for i in args[1:]]
+
+
+# --- with real repositories
+
+def restic(*args, env):
+    environ = os.environ.copy()
+    environ.update(env)
+    return subprocess.run(["restic"] + list(args), env=environ, check=True, capture_output=True,
+                          encoding="utf-8").stdout
+
+
+@pytest.fixture
+def repos(tmp_path):
+    if shutil.which("restic") is None:
+        pytest.skip("restic is not installed")
+    source = {"RESTIC_REPOSITORY": str(tmp_path / "source"), "RESTIC_PASSWORD": PASSWORD}
+    target = {"RESTIC_REPOSITORY": str(tmp_path / "target"), "RESTIC_PASSWORD": TARGET_PASSWORD}
+    restic("init", env=source)
+    restic("init", "--copy-chunker-params", env=dict(target, RESTIC_FROM_REPOSITORY=source["RESTIC_REPOSITORY"],
+                                                     RESTIC_FROM_PASSWORD=PASSWORD))
+    data = tmp_path / "data"
+    data.mkdir()
+    for i in range(3):
+        (data / f"file{i}.txt").write_text(f"version {i}")
+        restic("backup", "--host", "test", str(data), env=source)
+    return source, target
+
+
+def snapshot_ids(env):
+    return [s["id"] for s in sorted(json.loads(restic("snapshots", "--json", env=env)), key=lambda s: s["time"])]
+
+
+def make_replicator(tmp_path, repos, **kwargs):
+    source, target = repos
+    return CountingReplicator("restic", source, [ReplicationTarget("offsite", target, batch_size=1)],
+                              str(tmp_path / "replication-state.json"), **kwargs)
+
+
+def test_cancelled_replication_resumes_from_the_state_file(tmp_path, repos):
+    source, target = repos
+    ids = snapshot_ids(source)
+
+    replicator = make_replicator(tmp_path, repos, cancel_after=1)
+    with pytest.raises(ReplicationCancelled):
+        replicator.replicate()
+    state = json.loads((tmp_path / "replication-state.json").read_text())["offsite"]
+    assert state["copied"] == ids[:1]
+    assert state["pending"] == 2
+    lag = replicator.lag()["offsite"]
+    assert lag["pending"] == 2
+    assert lag["lag_seconds"] > 0
+    assert lag["last_success"] is None
+
+    resumed = make_replicator(tmp_path, repos)
+    resumed.replicate()
+    assert resumed.copied_ids() == ids[1:]
+    assert len(snapshot_ids(target)) == 3
+    lag = resumed.lag()["offsite"]
+    assert (lag["pending"], lag["lag_seconds"], lag["last_error"]) == (0, 0, None)
+    assert lag["last_success"] is not None
+
+
+def test_forgotten_snapshots_are_pruned_from_the_cursor(tmp_path, repos):
+    source, target = repos
+    ids = snapshot_ids(source)
+    make_replicator(tmp_path, repos).replicate()
+
+    restic("forget", ids[0], env=source)
+    replicator = make_replicator(tmp_path, repos)
+    replicator.replicate()
+    assert replicator.copied_ids() == []
+    assert replicator.state["offsite"]["copied"] == ids[1:]
+
+
+def test_empty_cursor_is_seeded_from_the_target(tmp_path, repos):
+    source, target = repos
+    ids = snapshot_ids(source)
+    make_replicator(tmp_path, repos).replicate()
+
+    os.remove(tmp_path / "replication-state.json")
+    replicator = make_replicator(tmp_path, repos)
+    replicator.replicate()
+    assert replicator.copied_ids() == []
+    assert replicator.state["offsite"]["copied"] == ids
+
+
+# --- with a fake restic
+
+# lists the snapshots in $RESTIC_REPOSITORY.json, records the copies in copies.txt
+FAKE_RESTIC = """
+    import os, sys
+    repository = os.environ["RESTIC_REPOSITORY"]
+    if sys.argv[1] == "snapshots":
+        print(open(repository + ".json").read())
+    elif sys.argv[1] == "copy":
+        with open(os.path.join(os.path.dirname(repository), "copies.txt"), "a") as f:
+            f.write(" ".join(sys.argv[2:]) + "\\n")
+"""
+
+
+def snapshot(id, hours_ago, **values):
+    time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=hours_ago)
+    return dict(id=id, time=time.isoformat(), **values)
+
+
+def make_fake_replicator(tmp_path, fake_restic, source, target):
+    (tmp_path / "source.json").write_text(json.dumps(source))
+    (tmp_path / "target.json").write_text(json.dumps(target))
+    return Replicator(fake_restic(FAKE_RESTIC), {"RESTIC_REPOSITORY": str(tmp_path / "source")},
+                      [ReplicationTarget("offsite", {"RESTIC_REPOSITORY": str(tmp_path / "target")}, batch_size=2)],
+                      str(tmp_path / "replication-state.json"))
+
+
+def copies(tmp_path):
+    if not os.path.exists(tmp_path / "copies.txt"):
+        return []
+    return [line.split() for line in (tmp_path / "copies.txt").read_text().splitlines()]
+
+
+def test_seeding_matches_the_original_ids(tmp_path, fake_restic):
+    source = [snapshot("a", 3), snapshot("b", 2, original="x"), snapshot("c", 1)]
+    # "a" copied once, "x" copied from elsewhere and then here
+    target = [snapshot("a2", 3, original="a"), snapshot("x3", 2, original="x")]
+    replicator = make_fake_replicator(tmp_path, fake_restic, source, target)
+    replicator.replicate()
+    assert copies(tmp_path) == [["c"]]
+    assert replicator.state["offsite"]["copied"] == ["a", "b", "c"]
+
+    # the cursor is used as is from now on
+    (tmp_path / "target.json").write_text("not listed again")
+    (tmp_path / "source.json").write_text(json.dumps(source[1:] + [snapshot("d", 0)]))
+    replicator.replicate()
+    assert copies(tmp_path) == [["c"], ["d"]]
+    assert replicator.state["offsite"]["copied"] == ["b", "c", "d"]
+    assert replicator.lag()["offsite"]["pending"] == 0
+
+
+def test_batches_and_lag(tmp_path, fake_restic):
+    source = [snapshot(i, 5 - n) for n, i in enumerate("abcde")]
+    replicator = make_fake_replicator(tmp_path, fake_restic, source, [])
+    assert replicator.lag()["offsite"]["pending"] is None
+    replicator.replicate()
+    assert copies(tmp_path) == [["a", "b"], ["c", "d"], ["e"]]
+    assert replicator.lag()["offsite"]["lag_seconds"] == 0
+
+    # a failed copy leaves the oldest pending snapshot as the lag
+    os.remove(tmp_path / "copies.txt")
+    os.mkdir(tmp_path / "copies.txt")
+    (tmp_path / "source.json").write_text(json.dumps(source + [snapshot("f", 2)]))
+    replicator.replicate()
+    lag = replicator.lag()["offsite"]
+    assert lag["pending"] == 1
+    assert lag["lag_seconds"] == pytest.approx(2 * 3600, abs=60)
+    assert "restic copy failed" in lag["last_error"]
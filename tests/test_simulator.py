@@ -0,0 +1,71 @@
+import asyncio
+import datetime
+
+import pytest
+
+from restic_monitor.scheduler import BackupScheduler
+from restic_monitor.simulator import ActivityTrace, VirtualClock, simulate
+
+START = datetime.datetime(2024, 1, 1)
+# active from 100 to 200 and from 1000 to 1100
+TRACE = ActivityTrace([(100, 200), (1000, 1100)], 2000)
+
+
+def run(cancel_on_activity=False, **kwargs):
+    scheduler = BackupScheduler(min_idle_seconds=50, min_seconds_between_backups=500,
+                                cancel_on_activity=cancel_on_activity)
+    return simulate("test", scheduler, TRACE, START, lambda: 300, no_backup_warning_seconds=600, **kwargs)
+
+
+def test_activity_trace():
+    assert TRACE.idle_time(50) == 50
+    assert TRACE.idle_time(150) == 0
+    assert TRACE.idle_time(250) == 50
+    assert TRACE.next_activity(300) == 1000
+    assert TRACE.next_activity(1050) == 1050
+    assert TRACE.next_activity(1500) is None
+    assert TRACE.active_seconds(0, 2000) == 200
+    assert TRACE.active_seconds(150, 1050) == 100
+
+
+def test_backups_overlap_activity_without_cancel():
+    # backups at ~50, ~850 and ~1650, 300s each
+    r = run()
+    assert (r.completed, r.cancelled) == (3, 0)
+    assert r.backup_seconds == pytest.approx(900)
+    assert r.overlap_seconds == pytest.approx(200)
+    # successes at ~350, ~1150 and ~1950, 200s past the warning twice
+    assert r.seconds_past_warning == pytest.approx(400, abs=1)
+
+
+def test_cancel_on_activity():
+    # the first backup is stopped within a second of the user coming back at 100,
+    # then backups at ~600 and ~1400 don't overlap any activity
+    r = run(cancel_on_activity=True)
+    assert (r.completed, r.cancelled) == (2, 1)
+    assert r.overlap_seconds <= 1
+    assert r.backup_seconds == pytest.approx(50 + 300 + 300, abs=2)
+
+
+def test_requested_runs_are_not_cancelled():
+    # "Run now" at 120 while the user is active wakes up the loop right away
+    r = run(cancel_on_activity=True, run_requests=[120])
+    assert (r.completed, r.cancelled) == (2, 2)
+    assert r.overlap_seconds == pytest.approx(80 + 1, abs=1)
+
+
+def test_pauses():
+    r = run(pauses=[(0, 900)])
+    assert (r.completed, r.cancelled) == (2, 0)
+    assert r.overlap_seconds == pytest.approx(100)
+
+    # pausing stops the running backup
+    r = run(pauses=[(200, 300)])
+    assert r.cancelled == 1
+    assert r.backup_seconds == pytest.approx(150 + 300 + 300, abs=1)
+
+
+def test_virtual_clock_can_replace_the_system_clock():
+    clock = VirtualClock(START)
+    asyncio.run(clock.sleep(90))
+    assert clock.now() == START + datetime.timedelta(seconds=90)
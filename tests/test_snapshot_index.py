@@ -0,0 +1,105 @@
+import asyncio
+
+from restic_monitor.snapshot_index import IndexingCancelled, SnapshotIndex, SnapshotIndexer
+
+
+def node(path, size=1):
+    return {"struct_type": "node", "type": "file", "path": path, "size": size, "mtime": "2024-01-01T10:00:00Z"}
+
+
+def test_versions_across_snapshots(tmp_path):
+    index = SnapshotIndex(str(tmp_path / "index.sqlite"))
+    index.add_snapshot({"id": "s1", "time": "2024-01-01T10:00:00Z"}, [node("/C/docs/report.docx"), node("/C/a.txt")])
+    index.add_snapshot({"id": "s2", "time": "2024-01-02T10:00:00Z"}, [node("/C/docs/report.docx", size=2)])
+    results = index.search("report")
+    assert [(r["snapshot"], r["size"]) for r in results] == [("s2", 2), ("s1", 1)]
+    index.forget_snapshots({"s1"})
+    assert [r["snapshot"] for r in index.search("report")] == ["s2"]
+    assert index.search("a.txt") == []
+    index.close()
+
+
+class FakeIndexer(SnapshotIndexer):
+    " counts the updates, which are interrupted while `blocked` "
+    def __init__(self, tmp_path):
+        super().__init__(str(tmp_path / "index.sqlite"), "restic", {}, check_seconds=3600, poll_seconds=0.01)
+        self.updates = 0
+        self.blocked = False
+
+    def update(self):
+        if self.blocked:
+            raise IndexingCancelled()
+        self.updates += 1
+        return 0
+
+
+def test_indexer_wakes_up_after_a_run_and_resumes_when_idle(tmp_path):
+    indexer = FakeIndexer(tmp_path)
+    idle = True
+    quit = False
+
+    async def scenario():
+        nonlocal idle, quit
+        task = asyncio.create_task(indexer.run(lambda: idle, lambda: quit))
+        await asyncio.sleep(0.1)
+        # the first check, then nothing until check_seconds
+        assert indexer.updates == 1
+
+        # a backup finished while the user is around
+        idle = False
+        indexer.on_run_finished({"code": 0})
+        await asyncio.sleep(0.1)
+        assert indexer.updates == 1
+
+        # the user is away again, the new snapshot is indexed right away
+        idle = True
+        await asyncio.sleep(0.1)
+        assert indexer.updates == 2
+
+        # failed runs don't add snapshots
+        indexer.on_run_finished({"code": 1})
+        await asyncio.sleep(0.1)
+        assert indexer.updates == 2
+
+        # an interrupted update is tried again on the next poll
+        indexer.blocked = True
+        indexer.on_run_finished({"code": 3})
+        await asyncio.sleep(0.1)
+        indexer.blocked = False
+        await asyncio.sleep(0.1)
+        assert indexer.updates == 3
+
+        quit = True
+        await asyncio.wait_for(task, 1)
+
+    asyncio.run(scenario())
+
+
+def test_interleaved_lineages_share_versions(tmp_path):
+    index = SnapshotIndex(str(tmp_path / "index.sqlite"))
+    main_files = [node(f"/C/docs/file{i}.txt") for i in range(100)]
+    for day in range(5):
+        time = f"2024-01-0{day + 1}T10:00:00Z"
+        index.add_snapshot({"id": f"main{day}", "time": time, "hostname": "pc", "paths": ["C:\\docs"]}, main_files)
+        # a stdin backup after every run, and the same paths from another host
+        index.add_snapshot({"id": f"db{day}", "time": time.replace("10:", "11:"), "hostname": "pc",
+                            "paths": ["/db.sql"]}, [node("/db.sql", size=day)])
+        index.add_snapshot({"id": f"laptop{day}", "time": time.replace("10:", "12:"), "hostname": "laptop",
+                            "paths": ["C:\\docs"]}, [node("/C/docs/file0.txt", size=2)])
+    versions = index.db.execute("SELECT COUNT(*) FROM versions").fetchone()[0]
+    # the main files once, a version of db.sql per day and one for the laptop
+    assert versions == 100 + 5 + 1
+
+    assert [r["snapshot"] for r in index.search("file5.txt")] == [f"main{day}" for day in reversed(range(5))]
+    results = index.search("file0.txt")
+    assert sorted((r["snapshot"], r["size"]) for r in results) == \
+        sorted([(f"main{day}", 1) for day in range(5)] + [(f"laptop{day}", 2) for day in range(5)])
+    assert [(r["snapshot"], r["size"]) for r in index.search("db.sql")] == \
+        [(f"db{day}", day) for day in reversed(range(5))]
+
+    # forgetting a snapshot in the middle of a lineage doesn't break the versions around it
+    index.forget_snapshots({"main2"})
+    index.add_snapshot({"id": "main5", "time": "2024-01-06T10:00:00Z", "hostname": "pc", "paths": ["C:\\docs"]},
+                       main_files)
+    assert [r["snapshot"] for r in index.search("file5.txt")] == ["main5", "main4", "main3", "main1", "main0"]
+    index.close()
@@ -0,0 +1,140 @@
+import asyncio
+import datetime
+import os
+import random
+import time
+
+import pytest
+
+from restic_monitor.history import RunHistory
+from restic_monitor.verifier import DeadlinePassed, RestoreVerifier, VerificationCancelled, restored_path
+
+
+class FakeVerifier(RestoreVerifier):
+    " the verifications are interrupted while `blocked` "
+    def __init__(self, tmp_path):
+        super().__init__("restic", {}, RunHistory(str(tmp_path / "run-history.json")), poll_seconds=0.01)
+        self.blocked = False
+
+    def verify(self, rng=None):
+        if self.blocked:
+            raise VerificationCancelled()
+        now = time.strftime("%Y-%m-%dT%H:%M:%S")
+        return {"started": now, "finished": now, "snapshot": "0123456789", "files": 1, "failed": 0}
+
+
+def test_interrupted_verification_starts_over_on_the_next_poll(tmp_path):
+    verifier = FakeVerifier(tmp_path)
+    verifier.blocked = True
+    quit = False
+
+    async def scenario():
+        nonlocal quit
+        task = asyncio.create_task(verifier.run(lambda: True, lambda: quit))
+        await asyncio.sleep(0.1)
+        assert verifier.history.last_verification() is None
+        verifier.blocked = False
+        await asyncio.sleep(0.1)
+        assert verifier.history.last_verification()["files"] == 1
+        quit = True
+        await asyncio.wait_for(task, 1)
+
+    asyncio.run(scenario())
+
+
+# answers like restic for the files under FAKE_LIVE, sleeps FAKE_SLEEP seconds before `ls`
+# and FAKE_RESTORE_SLEEP before `restore`, has no snapshot with FAKE_EMPTY
+FAKE_RESTIC = """
+    import datetime, json, os, shutil, sys, time
+    live = os.environ["FAKE_LIVE"]
+    command = sys.argv[1]
+    if command == "snapshots":
+        if os.environ.get("FAKE_EMPTY"):
+            print("[]")
+        else:
+            print(json.dumps([{"id": "0123456789", "time": "2024-01-01T10:00:00Z"}]))
+    elif command == "ls":
+        time.sleep(float(os.environ.get("FAKE_SLEEP", "0")))
+        for name in sorted(os.listdir(live)):
+            path = os.path.join(live, name)
+            mtime = datetime.datetime.fromtimestamp(os.path.getmtime(path)).astimezone().isoformat()
+            print(json.dumps({"struct_type": "node", "type": "file", "path": path,
+                              "size": os.path.getsize(path), "mtime": mtime}))
+    elif command == "restore":
+        time.sleep(float(os.environ.get("FAKE_RESTORE_SLEEP", "0")))
+        target = sys.argv[sys.argv.index("--target") + 1]
+        for i, arg in enumerate(sys.argv):
+            if arg == "--include":
+                path = sys.argv[i + 1]
+                restored = os.path.join(target, *[p for p in path.split("/") if p])
+                os.makedirs(os.path.dirname(restored), exist_ok=True)
+                shutil.copyfile(path, restored)
+"""
+
+
+@pytest.fixture
+def live_restic(tmp_path, fake_restic):
+    " the fake restic, and its environment "
+    live = tmp_path / "live"
+    live.mkdir()
+    for i in range(3):
+        (live / f"file{i}.txt").write_text(f"content {i}" * 100)
+    return fake_restic(FAKE_RESTIC), {"FAKE_LIVE": str(live)}
+
+
+def make_verifier(tmp_path, live_restic, **kwargs):
+    exe, env = live_restic
+    return RestoreVerifier(exe, env, RunHistory(str(tmp_path / "run-history.json")), workers=2, **kwargs)
+
+
+def test_files_are_restored_and_compared(tmp_path, live_restic):
+    record = make_verifier(tmp_path, live_restic).verify(random.Random(1))
+    assert record["snapshot"] == "0123456789"
+    assert (record["files"], record["compared"], record["not_checked"], record["failed"]) == (3, 3, 0, 0)
+
+
+def test_changed_content_fails(tmp_path, live_restic):
+    verifier = make_verifier(tmp_path, live_restic)
+    exe, env = live_restic
+    node = {"path": os.path.join(env["FAKE_LIVE"], "file0.txt"), "size": 900}
+    restored = tmp_path / "restored" / restored_path("", node["path"])
+    restored.parent.mkdir(parents=True)
+    restored.write_text("x" * 900)
+    node["mtime"] = datetime.datetime.fromtimestamp(os.path.getmtime(node["path"])).astimezone().isoformat()
+    target = str(tmp_path / "restored")
+    assert verifier._check(node, target, time.monotonic() + 60) == \
+        (True, "content differs from the unchanged live file")
+    with pytest.raises(DeadlinePassed):
+        verifier._check(node, target, time.monotonic() - 1)
+
+
+def test_slow_ls_is_killed_at_the_deadline(tmp_path, live_restic):
+    exe, env = live_restic
+    verifier = RestoreVerifier(exe, dict(env, FAKE_SLEEP="60"), RunHistory(str(tmp_path / "run-history.json")),
+                               max_seconds=1)
+    started = time.monotonic()
+    with pytest.raises(Exception, match="timed out"):
+        verifier.verify()
+    assert time.monotonic() - started < 10
+    assert not verifier.procs
+
+
+def test_restore_killed_at_the_deadline_is_not_a_failure(tmp_path, live_restic):
+    exe, env = live_restic
+    verifier = RestoreVerifier(exe, dict(env, FAKE_RESTORE_SLEEP="60"), RunHistory(str(tmp_path / "run-history.json")),
+                               max_seconds=2)
+    started = time.monotonic()
+    record = verifier.verify()
+    assert time.monotonic() - started < 10
+    assert (record["files"], record["compared"], record["not_checked"], record["failed"]) == (3, 0, 3, 0)
+    assert record["failures"] == []
+
+
+def test_no_snapshot_is_recorded_and_retried_later(tmp_path, live_restic):
+    exe, env = live_restic
+    verifier = RestoreVerifier(exe, dict(env, FAKE_EMPTY="1"), RunHistory(str(tmp_path / "run-history.json")),
+                               retry_seconds=3600)
+    record = verifier.verify()
+    assert record["no_snapshot"]
+    verifier.history.add_verification(record)
+    assert not verifier.is_due()